@@ -1,17 +1,21 @@
 #!/usr/bin/env python3
 import sys
 
-from signal import SIGINT
+from signal import SIGINT, SIGKILL, SIGTERM
 
 sys.path += ['.']  # noqa
 
+import asyncio
 import json
+import os
 import traceback
 import random
-from os.path import join, dirname, realpath, isfile
-from subprocess import call, Popen, PIPE, check_output
-from threading import Thread, Timer, Event
-from time import sleep
+import re
+from collections import Counter
+from os.path import join, dirname, realpath, isfile, exists
+from subprocess import Popen, PIPE
+from threading import Condition, Thread, Event
+from time import monotonic, sleep
 from websocket import WebSocketApp
 
 
@@ -30,9 +34,41 @@ if mock:
     exe_file = 'wifisetup/mock_main.py'
 
 
+# Must match wifisetup.util.EVENT_FD_ENV
+EVENT_FD_ENV = 'WIFISETUP_EVENT_FD'
+
+# Deadlines for the wifi setup process, in seconds
+WIFI_READY_TIMEOUT = 30  # the access point should be up by then
+WIFI_SIGINT_TIMEOUT = 10  # time to shut down cleanly after SIGINT
+WIFI_SIGTERM_TIMEOUT = 3  # time to exit after SIGTERM before SIGKILL
+
+
+def load_dialogs():
+    """Read every dialog of every language, {lang: {name: [lines]}}"""
+    catalog = {}
+    dialog_dir = get_resource('dialog')
+    try:
+        languages = os.listdir(dialog_dir)
+    except OSError:
+        print('No dialogs found in', dialog_dir)
+        return catalog
+    for language in languages:
+        catalog[language] = {}
+        for file_name in os.listdir(join(dialog_dir, language)):
+            name, ext = os.path.splitext(file_name)
+            if ext == '.dialog':
+                with open(join(dialog_dir, language, file_name)) as f:
+                    lines = list(filter(bool, f.read().split('\n')))
+                catalog[language][name] = lines
+    return catalog
+
+
+dialogs = load_dialogs()
+
+
 def get_dialog(name):
-    with open(get_resource(join('dialog', lang, name + '.dialog'))) as f:
-        return random.choice(list(filter(bool, f.read().split('\n'))))
+    lines = dialogs.get(lang, {}).get(name) or dialogs['en-us'][name]
+    return random.choice(lines)
 
 
 def speak_dialog(client, dialog_name):
@@ -40,13 +76,120 @@ def speak_dialog(client, dialog_name):
     client.send(json.dumps({'type': 'speak', 'data': {'utterance': text}}))
 
 
+def send_message(client, msg_type, data=None):
+    client.send(json.dumps({'type': msg_type, 'data': data or {}}))
+
+
+async def call_async(args, shell=False):
+    """Run a command without blocking the event loop, return its exit code"""
+    if shell:
+        proc = await asyncio.create_subprocess_shell(args)
+    else:
+        proc = await asyncio.create_subprocess_exec(*args)
+    return await proc.wait()
+
+
+async def check_output_async(args):
+    proc = await asyncio.create_subprocess_exec(*args, stdout=PIPE)
+    stdout, _ = await proc.communicate()
+    return stdout
+
+
+class MouthWriter(Thread):
+    """
+    Keep the enclosure's serial port open and write mouth text to it.
+    Text set while a write is in progress replaces any older pending text
+    """
+    def __init__(self, device):
+        super(MouthWriter, self).__init__(daemon=True)
+        self.device = device
+        self.cond = Condition()
+        self.text = None
+        self.port = None
+
+    def show(self, text):
+        with self.cond:
+            self.text = text
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.text is None:
+                    self.cond.wait()
+                text, self.text = self.text, None
+            self.write(text)
+
+    def write(self, text):
+        try:
+            if self.port is None:
+                self.port = open(self.device, 'w')
+            self.port.write('mouth.text=' + text + '\n')
+            self.port.flush()
+        except OSError:
+            self.port = None  # reopen on the next update
+
+
+mouth = MouthWriter('/dev/ttyAMA0')
+if exists(mouth.device):
+    mouth.start()
+
+
 def show_text(text):
-    try:
-        if isfile('/dev/ttyAMA0'):
-            call('echo "mouth.text=' + text + '" > /dev/ttyAMA0 &>/dev/null',
-                 shell=True)
-    except OSError:
-        pass
+    mouth.show(text)
+
+
+class ChildSupervisor:
+    """
+    Run a child process, reaping it the moment it exits, and stop it with
+    escalating signals. Records how long bring-up and teardown took
+    """
+    def __init__(self, args, **kwargs):
+        self.ready = Event()
+        self.exited = Event()
+        self.started = monotonic()
+        self.ready_at = self.stopping_at = self.exited_at = None
+        self.proc = Popen(args, **kwargs)
+        Thread(target=self.reap, daemon=True).start()
+
+    def reap(self):
+        self.proc.wait()  # waitpid() blocks until the child is gone
+        self.exited_at = monotonic()
+        self.exited.set()
+        self.ready.set()  # nothing left to wait for
+
+    def set_ready(self):
+        if not self.ready.is_set():
+            self.ready_at = monotonic()
+            self.ready.set()
+
+    def wait_ready(self, timeout):
+        """True if the child signalled readiness before the timeout"""
+        self.ready.wait(timeout)
+        return self.ready_at is not None
+
+    def stop(self, sigint_timeout, sigterm_timeout):
+        """Ask the child to exit, escalating until it does"""
+        self.stopping_at = monotonic()
+        for sig, timeout in [(SIGINT, sigint_timeout),
+                             (SIGTERM, sigterm_timeout), (SIGKILL, None)]:
+            if self.exited.is_set():
+                break
+            print('Sending {} to pid {}'.format(sig.name, self.proc.pid))
+            self.proc.send_signal(sig)
+            self.exited.wait(timeout)
+        return self.durations()
+
+    def durations(self):
+        def since(start, end):
+            return None if start is None or end is None else \
+                round(end - start, 3)
+        return {
+            'bring_up': since(self.started, self.ready_at),
+            'teardown': since(self.stopping_at, self.exited_at),
+            'total': since(self.started, self.exited_at),
+            'returncode': self.proc.returncode
+        }
 
 
 def run_wifi_setup(client, data):
@@ -77,12 +220,23 @@ def run_wifi_setup(client, data):
     global lang
     lang = data.get('lang', lang)
     allow_timeout = data.get('allow_timeout', True)
-    p = Popen([exe_file, 'wifi.run', str(allow_timeout)],
-              stdout=PIPE, stderr=sys.stderr.buffer)
+    event_r, event_w = os.pipe()
+    child = ChildSupervisor(
+        [exe_file, 'wifi.run', str(allow_timeout)],
+        stdout=PIPE, stderr=sys.stderr.buffer, pass_fds=[event_w],
+        env=dict(os.environ, **{EVENT_FD_ENV: str(event_w)})
+    )
+    os.close(event_w)  # EOF on the read end once the child exits
 
     def notify(event):
-        """Continuously show and speak a message to the user on an event"""
+        """
+        Continuously show and speak a message to the user on an event.
+        Runs on the event loop, which also schedules the next prompt
+        """
         print('Notifying event:', event)
+        if notify.prompt:
+            notify.prompt.cancel()
+            notify.prompt = None
         if event == 'exit':
             notify.quit_event.set()
             show_text('')
@@ -96,61 +250,81 @@ def run_wifi_setup(client, data):
         delay = 0.1 if next_event != event else 45
 
         notify.quit_event.clear()
-        notify.timer.cancel()
-        notify.timer = Timer(delay, notify, [next_event])
-        notify.timer.start()
+        notify.prompt = loop.call_later(delay, notify, next_event)
+        child.set_ready()  # the first event shows the child is up
 
         if event in dialog_events:
             speak_dialog(client, event)
         if event in visual_events:
             show_text(visual_events[event])
 
+    def parse_events():
+        """Structured events: one JSON object per line on the event pipe"""
+        with open(event_r, 'rb') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    print('Invalid event line:', line)
+                    continue
+                print('Event {} from {} after {:.1f}ms: {}'.format(
+                    event['event'], event.get('component'),
+                    (monotonic() - event['ts']) * 1000, event.get('data')))
+                post(event['event'])
+
     def parse_output():
-        for line in p.stdout:
+        """Bare event names on stdout, used by children without the pipe"""
+        for line in child.proc.stdout:
             event = line.decode().strip()
-            notify(event)
-        if not notify.quit_event.is_set():
-            notify('exit')
+            if event:
+                post(event)
+        events_thread.join()
+        post('exit')
 
-    Thread(target=parse_output, daemon=True).start()
+    def post(event):
+        loop.call_soon_threadsafe(notify, event)
 
     notify.quit_event = Event()
     notify.quit_event.set()
-    notify.timer = Timer(10, speak_dialog, [client, 'ap_error'])
-    notify.timer.start()
-    notify.timer.join()
+    notify.prompt = None
+
+    events_thread = Thread(target=parse_events, daemon=True)
+    events_thread.start()
+    Thread(target=parse_output, daemon=True).start()
+
+    if not child.wait_ready(WIFI_READY_TIMEOUT):
+        speak_dialog(client, 'ap_error')
 
     notify.quit_event.wait()
-    p.send_signal(SIGINT)
-    sleep(10)  # Give the wifi setup process time to shutdown of it's own
-    p.terminate()  # In case anything has gone bonkers, terminate the process
+    durations = child.stop(WIFI_SIGINT_TIMEOUT, WIFI_SIGTERM_TIMEOUT)
+    print('Wifi setup session:', durations)
 
 
-def ntp_sync(client, data):
+async def ntp_sync(client, data):
     # Force the system clock to synchronize with internet time servers
-    call('service ntp stop', shell=True)
-    call('ntpd -gq', shell=True)
-    call('service ntp start', shell=True)
+    await call_async('service ntp stop', shell=True)
+    await call_async('ntpd -gq', shell=True)
+    await call_async('service ntp start', shell=True)
     client.send(json.dumps({'type': 'system.ntp.sync.complete'}))
 
 
-def system_shutdown(*_):
+async def system_shutdown(*_):
     # Turn the system completely off (with no option to inhibit it)
-    call('systemctl poweroff -i', shell=True)
+    await call_async('systemctl poweroff -i', shell=True)
 
 
-def system_reboot(*_):
+async def system_reboot(*_):
     # Shut down and restart the system
-    call('systemctl reboot -i', shell=True)
+    await call_async('systemctl reboot -i', shell=True)
 
 
-def update_only_mycroft():
-    call(['apt-get', 'update', '-o', 'Dir::Etc::sourcelist=sources.list.d/repo.mycroft.ai.list',
-          '-o', 'Dir::Etc::sourceparts=-', '-o', 'APT::Get::List-Cleanup=0'])
+async def update_only_mycroft():
+    await call_async(['apt-get', 'update', '-o', 'Dir::Etc::sourcelist=sources.list.d/repo.mycroft.ai.list',
+                      '-o', 'Dir::Etc::sourceparts=-', '-o', 'APT::Get::List-Cleanup=0'])
 
 
-def get_core_version():
-    lines = check_output(['dpkg', '--list']).decode().split('\n')
+async def get_core_version():
+    lines = (await check_output_async(['dpkg', '--list'])).decode().split('\n')
     try:
         line = next(i for i in lines if 'mycroft-core' in i)
         status, name, version, arch, desc = line.split()
@@ -173,39 +347,46 @@ def get_mycroft_package(data):
 
 APT_PLATFORMS = ['mycroft_mark_1']
 
-def system_update(client, data):
+async def system_update(client, data):
     if data.get('platform', 'unknown') in APT_PLATFORMS:
         client.send(json.dumps({'type': 'system.update.processing'}))
-        update_only_mycroft()
-        version_before = get_core_version()
-        call(['apt-get', 'install', get_mycroft_package(data), '-y'])
-        version_after = get_core_version()
+
+        def progress(step):
+            send_message(client, 'system.update.progress', {'step': step})
+
+        progress('refresh')
+        await update_only_mycroft()
+        version_before = await get_core_version()
+        progress('install')
+        await call_async(['apt-get', 'install', get_mycroft_package(data), '-y'])
+        version_after = await get_core_version()
         has_updated = version_before != version_after
         if has_updated:
-            call(['service', 'mycroft-skills', 'stop'])
-            call(['mycroft-msm', 'default'])
-            call(['service', 'mycroft-skills', 'start'])
+            progress('skills')
+            await call_async(['service', 'mycroft-skills', 'stop'])
+            await call_async(['mycroft-msm', 'default'])
+            await call_async(['service', 'mycroft-skills', 'start'])
         client.send(json.dumps({
             'type': 'system.update.complete',
             'data': {'has_updated': has_updated}
         }))
 
 
-def ssh_enable(*_):
+async def ssh_enable(*_):
     # Permanently allow SSH access
-    call('systemctl enable ssh.service', shell=True)
-    call('systemctl start ssh.service', shell=True)
+    await call_async('systemctl enable ssh.service', shell=True)
+    await call_async('systemctl start ssh.service', shell=True)
 
 
-def ssh_disable(*_):
+async def ssh_disable(*_):
     # Permanently block SSH access from the outside
-    call('systemctl stop ssh.service', shell=True)
-    call('systemctl disable ssh.service', shell=True)
+    await call_async('systemctl stop ssh.service', shell=True)
+    await call_async('systemctl disable ssh.service', shell=True)
 
 
-def reset_system(*_):
+async def reset_system(*_):
     # Remove all skills except Pairing (which is needed after wipe)
-    call("""mkdir -p /opt/mycroft/safety &&
+    await call_async("""mkdir -p /opt/mycroft/safety &&
     mv /opt/mycroft/skills/mycroft-pairing.mycroftai /opt/mycroft/safety &&
     rm -rf /opt/mycroft/skills/* &&
     mv /opt/mycroft/safety/mycroft-pairing.mycroftai /opt/mycroft/skills &&
@@ -214,37 +395,119 @@ def reset_system(*_):
     """, shell=True)
 
     # Zap the MSM info and cache files
-    call("rm -rf /opt/mycroft/.skills-repo", shell=True)
-    call("rm -f /opt/mycroft/skills/.msm", shell=True)
+    await call_async("rm -rf /opt/mycroft/.skills-repo", shell=True)
+    await call_async("rm -f /opt/mycroft/skills/.msm", shell=True)
 
     # Zap user data
-    call("rm -rf /home/mycroft/.mycroft", shell=True)
+    await call_async("rm -rf /home/mycroft/.mycroft", shell=True)
 
     # Reset network settings
-    call([exe_file, 'wifi.reset'])
+    await call_async([exe_file, 'wifi.reset'])
+
+
+# Handlers that must not run more than this many times at once.
+# The rest run concurrently without limit
+CONCURRENCY_LIMITS = {
+    run_wifi_setup: 1,
+    reset_system: 1,
+    ntp_sync: 1,
+    system_update: 1,
+    ssh_enable: 1,
+    ssh_disable: 1
+}
+semaphores = {}
+
+
+async def run_handler(handler, client, data):
+    """Run a handler on the event loop, threaded if it is not a coroutine"""
+    limit = CONCURRENCY_LIMITS.get(handler)
+    if limit and handler not in semaphores:
+        semaphores[handler] = asyncio.Semaphore(limit)
+    semaphore = semaphores.get(handler)
+    try:
+        if semaphore:
+            await semaphore.acquire()
+        if asyncio.iscoroutinefunction(handler):
+            await handler(client, data)
+        else:
+            await loop.run_in_executor(None, handler, client, data)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        if semaphore:
+            semaphore.release()
+
+
+def schedule(handler, client, data):
+    """Hand a message to the event loop from the websocket thread"""
+    asyncio.run_coroutine_threadsafe(run_handler(handler, client, data), loop)
+
+
+async def send_stats(client, data):
+    send_message(client, 'system.admin.stats.response', get_stats())
+
+
+# TODO: Retire the mycroft.XXX messages, keeping for backwards compat
+ROUTES = {
+    'system.wifi.setup': run_wifi_setup,
+    'mycroft.wifi.start': run_wifi_setup,
+    'system.wifi.reset': reset_system,
+    'mycroft.wifi.reset': reset_system,
+    'system.ssh.enable': ssh_enable,
+    'mycroft.enable.ssh': ssh_enable,
+    'system.ssh.disable': ssh_disable,
+    'mycroft.disable.ssh': ssh_disable,
+    'system.ntp.sync': ntp_sync,
+    'system.reboot': system_reboot,
+    'system.shutdown': system_shutdown,
+    'system.update': system_update,
+    'system.admin.stats': send_stats,
+}
+
+# Finds the types of a raw frame that start like one of ours so that the
+# rest of the bus traffic is dropped without being decoded
+TYPE_PATTERN = re.compile(r'"type"\s*:\s*"((?:{})\.[^"]*)"'.format(
+    '|'.join(sorted({re.escape(t.split('.')[0]) for t in ROUTES}))))
+
+STATS_INTERVAL = 600  # seconds between printed routing summaries
+stats = {
+    'received': 0,
+    'decoded': 0,
+    'decode_time': 0.0,
+    'handled': Counter(),
+    'since': monotonic(),
+    'last_report': monotonic()
+}
+
+
+def get_stats():
+    return {
+        'received': stats['received'],
+        'decoded': stats['decoded'],
+        'decode_ms': round(stats['decode_time'] * 1000, 3),
+        'handled': dict(stats['handled']),
+        'uptime': round(monotonic() - stats['since'])
+    }
 
 
 def on_message(client, message):
+    stats['received'] += 1
+    if monotonic() - stats['last_report'] > STATS_INTERVAL:
+        stats['last_report'] = monotonic()
+        print('Routing stats:', get_stats())
+
+    if not any(t in ROUTES for t in TYPE_PATTERN.findall(message)):
+        return
+    start = monotonic()
     message = json.loads(message)
-    print(message)
-
-    # TODO: Retire the mycroft.XXX messages, keeping for backwards compat
-    handler = {
-        'system.wifi.setup': run_wifi_setup,
-        'mycroft.wifi.start': run_wifi_setup,
-        'system.wifi.reset': reset_system,
-        'mycroft.wifi.reset': reset_system,
-        'system.ssh.enable': ssh_enable,
-        'mycroft.enable.ssh': ssh_enable,
-        'system.ssh.disable': ssh_disable,
-        'mycroft.disable.ssh': ssh_disable,
-        'system.ntp.sync': ntp_sync,
-        'system.reboot': system_reboot,
-        'system.shutdown': system_shutdown,
-        'system.update': system_update,
-    }.get(message['type'])
+    stats['decode_time'] += monotonic() - start
+    stats['decoded'] += 1
+
+    handler = ROUTES.get(message['type'])
     if handler:
-        handler(client, message['data'])
+        print('Handling', message['type'])
+        stats['handled'][message['type']] += 1
+        schedule(handler, client, message.get('data') or {})
 
 
 def main():
@@ -255,18 +518,29 @@ def main():
     print('Starting client on:', url)
     client = WebSocketApp(url=url, on_message=on_message)
     if mock:
-        Thread(target=run_wifi_setup, args=[client, {}], daemon=True).start()
+        schedule(run_wifi_setup, client, {})
     client.run_forever()
     print('Client stopped.')
 
 
-if __name__ == '__main__':
+def run_client():
     # Run loop trying to reconnect if there are any issues starting
     # the websocket
     while True:
         try:
             main()
-        except KeyboardInterrupt:
-            raise
         except:
             traceback.print_exc()
+
+
+# Handlers run on this loop, in the main thread so that asyncio can watch
+# child processes on every Python version
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+
+if __name__ == '__main__':
+    Thread(target=run_client, daemon=True).start()
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
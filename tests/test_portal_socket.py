@@ -0,0 +1,82 @@
+import json
+import socket
+import unittest
+from threading import Thread
+from time import sleep
+from unittest import mock
+
+from wifisetup import portal_socket
+from wifisetup.portal_socket import OP_PING, OP_PONG, OP_TEXT, PortalHub, \
+    PortalSocket
+
+
+def socket_of(connection):
+    return PortalSocket(connection, connection.makefile('rb'),
+                        connection.makefile('wb', buffering=0))
+
+
+class TestPortalHub(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(portal_socket, 'PING_INTERVAL', 0.1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.hub = PortalHub()
+        self.received = []
+        self.hub.on_message = lambda name, data: self.received.append(name)
+
+    def connect(self):
+        server, client = socket.socketpair()
+        server.settimeout(5)  # like the request handler's timeout
+        client.settimeout(5)
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+        thread = Thread(target=self.hub.serve, args=(socket_of(server),),
+                        daemon=True)
+        thread.start()
+        return socket_of(client), thread
+
+    def read_message(self, page):
+        """Next message to the page, answering pings on the way"""
+        while True:
+            fin, opcode, payload = page.read_frame()
+            if opcode == OP_PING:
+                page.send(OP_PONG, payload)
+            elif opcode == OP_TEXT:
+                return json.loads(payload.decode())
+
+    def test_idle_connection_stays_open(self):
+        page, thread = self.connect()
+        pings = 0
+        while pings < 5:  # idle for several ping intervals
+            fin, opcode, payload = page.read_frame()
+            self.assertEqual(opcode, OP_PING)
+            page.send(OP_PONG, payload)
+            pings += 1
+        self.hub.send('wifi.scanned', {'networks': {}})
+        self.assertEqual(self.read_message(page)['type'], 'wifi.scanned')
+        page.send_message('wifi.scan')
+        sleep(0.2)
+        self.assertEqual(self.received, ['wifi.scan'])
+        self.assertTrue(thread.is_alive())
+
+    def test_unanswered_ping_closes(self):
+        page, thread = self.connect()
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.hub.sockets, set())
+
+    def test_reconnect_receives_held_messages(self):
+        self.hub.send('connection.status', {'connected': False})
+        self.hub.send('wifi.scanned', {'networks': {'home': {}}, 'seq': 1})
+        self.hub.send('wifi.scanned', {'seq': 2, 'added': {}, 'changed': {},
+                                       'removed': ['home']})
+        page, thread = self.connect()
+        self.assertEqual(self.read_message(page),
+                         {'type': 'connection.status',
+                          'data': {'connected': False}})
+        self.assertEqual(self.read_message(page)['data']['seq'], 1)
+        self.assertEqual(self.hub.held, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
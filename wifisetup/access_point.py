@@ -14,27 +14,52 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with Mycroft Core.  If not, see <http://www.gnu.org/licenses/>.
+import os
 from logging import getLogger
-from shutil import copyfile
-from pyric import pyw
+from os.path import isfile, join
+from signal import SIGTERM
+from subprocess import TimeoutExpired
+from time import monotonic, sleep
 
-from wifisetup.util import wpa, sysctrl
+from wifisetup import config
+from wifisetup.backend import create_backend
+from wifisetup.util import cli, executor, wpa, wpa_passphrase, \
+    close_wpa_ctrl
 
 LOG = getLogger(__name__)
 
+DNSMASQ_START_TIMEOUT = 5  # seconds until dnsmasq must have its sockets
+DNSMASQ_STOP_TIMEOUT = 2  # seconds after SIGTERM before it is killed
+SYSTEM_DNSMASQ = 'dnsmasq.service'  # would hold the dns and dhcp ports
+
 
 class AccessPoint:
     template = """interface={interface}
+except-interface=lo
 bind-interfaces
 server={server}
 domain-needed
 bogus-priv
 dhcp-range={dhcp_range_start}, {dhcp_range_end}, 12h
 address=/#/{server}
+dhcp-leasefile={lease_file}
+pid-file={pid_file}
+"""
+    # Appended when dns is answered by DnsServer instead of dnsmasq
+    dhcp_only_template = """port=0
+dhcp-option=option:dns-server,{server}
 """
 
-    def __init__(self, wiface):
+    def __init__(self, wiface, run_dir=config.dnsmasq_dir, serve_dns=True,
+                 backend=None):
         self.wiface = wiface
+        self.backend = backend or create_backend()
+        self.serve_dns = serve_dns
+        self.conf_file = join(run_dir, 'dnsmasq.conf')
+        self.pid_file = join(run_dir, 'dnsmasq.pid')
+        self.lease_file = join(run_dir, 'dnsmasq.leases')
+        self.dnsmasq = None
+        self.stopped_system_dnsmasq = False
         self.subnet = '172.24.1'
         self.ip = self.subnet + '.1'
         self.ip_start = self.subnet + '.50'
@@ -42,40 +67,122 @@ address=/#/{server}
 
         wpa(self.wiface, 'p2p_group_add', 'persistent=0')
         self.iface = self.get_iface()
-        self.password = wpa(self.iface, 'p2p_get_passphrase')
+        self.password = wpa_passphrase(self.iface)
 
         LOG.debug('Wiface: ' + self.wiface)
         LOG.debug('Iface: ' + self.iface)
 
-        card = pyw.getcard(self.iface)
-        pyw.inetset(card, self.ip)
-        copyfile('/etc/dnsmasq.conf', '/tmp/dnsmasq-bk.conf')
+        self.backend.set_address(self.iface, self.ip)
+        os.makedirs(run_dir, exist_ok=True)
         self.save()
-        sysctrl('restart', 'dnsmasq.service')
+        self.backend.start_dhcp(self)
 
     def get_iface(self):
-        for iface in pyw.winterfaces():
+        for iface in self.backend.interfaces():
             if "p2p" in iface:
                 return iface
         raise RuntimeError('No p2p interfaces are up')
 
+    def stop_stale_dnsmasq(self):
+        """Stop a dnsmasq left running by a session that crashed"""
+        try:
+            with open(self.pid_file) as f:
+                pid = int(f.read().strip())
+            with open('/proc/%d/comm' % pid) as f:
+                if f.read().strip() != 'dnsmasq':
+                    return
+            LOG.warning('Stopping stale dnsmasq with pid %d', pid)
+            os.kill(pid, SIGTERM)
+            start = monotonic()
+            while os.path.exists('/proc/%d' % pid) and \
+                    monotonic() - start < DNSMASQ_STOP_TIMEOUT:
+                sleep(0.01)
+        except (OSError, ValueError):
+            pass
+
+    def stop_system_dnsmasq(self):
+        """Stop the dnsmasq service for the session if it is running"""
+        try:
+            if cli('systemctl', 'is-active', '--quiet',
+                   SYSTEM_DNSMASQ)['code'] != 0:
+                return
+        except OSError:
+            return  # no systemd
+        LOG.info('Stopping %s for the access point', SYSTEM_DNSMASQ)
+        result = cli('systemctl', 'stop', SYSTEM_DNSMASQ)
+        if result['code'] != 0:
+            raise RuntimeError('Could not stop %s, it holds the dns and dhcp '
+                               'ports: %s' % (SYSTEM_DNSMASQ,
+                                              result['stderr'].strip()))
+        self.stopped_system_dnsmasq = True
+
+    def start_dnsmasq(self):
+        """Run a private dnsmasq that only serves the access point"""
+        self.stop_stale_dnsmasq()
+        self.stop_system_dnsmasq()
+        for path in (self.pid_file, self.lease_file):
+            remove_file(path)
+        start = monotonic()
+        self.dnsmasq = executor.spawn(['dnsmasq', '--keep-in-foreground',
+                                       '--conf-file=' + self.conf_file])
+        # The pid file is written once the sockets are bound
+        while not isfile(self.pid_file):
+            if self.dnsmasq.poll() is not None:
+                self.stop_dnsmasq()
+                raise RuntimeError('dnsmasq exited with code %d' %
+                                   self.dnsmasq.returncode)
+            if monotonic() - start > DNSMASQ_START_TIMEOUT:
+                self.stop_dnsmasq()
+                raise RuntimeError('dnsmasq did not start')
+            sleep(0.01)
+        LOG.info('dnsmasq started in %.0fms',
+                 (monotonic() - start) * 1000)
+
+    def stop_dnsmasq(self):
+        if self.dnsmasq and self.dnsmasq.poll() is None:
+            start = monotonic()
+            self.dnsmasq.terminate()
+            try:
+                self.dnsmasq.wait(DNSMASQ_STOP_TIMEOUT)
+            except TimeoutExpired:
+                LOG.warning('dnsmasq did not exit, killing it')
+                self.dnsmasq.kill()
+                self.dnsmasq.wait()
+            LOG.info('dnsmasq stopped in %.0fms',
+                     (monotonic() - start) * 1000)
+        for path in (self.conf_file, self.pid_file, self.lease_file):
+            remove_file(path)
+        if self.stopped_system_dnsmasq:
+            cli('systemctl', 'start', SYSTEM_DNSMASQ)
+            self.stopped_system_dnsmasq = False
+
     def close(self):
-        sysctrl('stop', 'dnsmasq.service')
-        sysctrl('disable', 'dnsmasq.service')
+        self.backend.stop_dhcp(self)
         wpa(self.wiface, 'p2p_group_remove', self.iface)
-        copyfile('/tmp/dnsmasq-bk.conf', '/etc/dnsmasq.conf')
+        close_wpa_ctrl(self.iface)
 
     def save(self):
         data = {
             "interface": self.iface,
             "server": self.ip,
             "dhcp_range_start": self.ip_start,
-            "dhcp_range_end": self.ip_end
+            "dhcp_range_end": self.ip_end,
+            "lease_file": self.lease_file,
+            "pid_file": self.pid_file
         }
         try:
-            LOG.info("Writing to: /etc/dnsmasq.conf")
-            with open('/etc/dnsmasq.conf', 'w') as f:
+            LOG.info("Writing to: " + self.conf_file)
+            with open(self.conf_file, 'w') as f:
                 f.write(self.template.format(**data))
+                if not self.serve_dns:
+                    f.write(self.dhcp_only_template.format(**data))
         except Exception as e:
-            LOG.error("Fail to write: /etc/dnsmasq.conf")
+            LOG.error("Fail to write: " + self.conf_file)
             raise e
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
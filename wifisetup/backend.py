@@ -0,0 +1,190 @@
+# Copyright 2017 Mycroft AI, Inc.
+#
+# This file is part of Mycroft Wifi Setup.
+#
+# Mycroft Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mycroft Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mycroft Core.  If not, see <http://www.gnu.org/licenses/>.
+import shutil
+import tempfile
+from logging import getLogger
+from os.path import join
+from threading import Event
+from time import monotonic
+
+from pyric import pyw
+
+from wifisetup import config
+from wifisetup.scanner import Nl80211Scanner
+from wifisetup.util import executor
+from wifisetup.wpa_ctrl import CTRL_DIR, WpaEventDispatcher, \
+    WpaEventListener
+
+LOG = getLogger(__name__)
+
+REPLAY_HTTP_PORT = 8080  # portal of a replayed session, on localhost
+
+
+class CommandScanner:
+    """
+    Nl80211Scanner whose calls are timed, recorded and replayed by the
+    executor. Raises OSError like the scanner when there is no result
+    """
+    def __init__(self, iface, scanner=None):
+        self.iface = iface
+        self.scanner = scanner
+
+    def call(self, name):
+        result = executor.run(['nl80211', name, self.iface],
+                              lambda: getattr(self.scanner, name)())
+        if result is None:
+            raise OSError('No nl80211 %s recorded for %s' % (name, self.iface))
+        return result
+
+    def scan(self):
+        return self.call('scan')
+
+    def results(self):
+        return self.call('results')
+
+    def close(self):
+        if self.scanner:
+            self.scanner.close()
+
+
+class RecordingEventListener(WpaEventListener):
+    """ WpaEventListener that records its events and their timing on stop """
+
+    def __init__(self, iface, ctrl_dir=CTRL_DIR):
+        super(RecordingEventListener, self).__init__(iface, ctrl_dir)
+        self.created = monotonic()
+        self.events = []
+
+    def dispatch(self, message):
+        self.events.append([round(monotonic() - self.created, 6), message])
+        super(RecordingEventListener, self).dispatch(message)
+
+    def stop(self):
+        if self.wake_write is not None:
+            executor.record(['wpa_events', self.iface], self.events,
+                            monotonic() - self.created)
+        super(RecordingEventListener, self).stop()
+
+
+class ReplayedEventListener(WpaEventDispatcher):
+    """ Dispatch recorded events at the same offsets after creation """
+
+    def __init__(self, iface, events):
+        super(ReplayedEventListener, self).__init__(iface)
+        self.created = monotonic()
+        self.events = events
+        self.stopped = Event()
+
+    def run(self):
+        for offset, message in self.events:
+            if self.stopped.wait(max(self.created + offset - monotonic(), 0)):
+                break
+            self.dispatch(message)
+        self.running = False
+
+    def stop(self):
+        self.running = False
+        self.stopped.set()
+
+
+class SystemBackend:
+    """
+    The parts of the system WifiClient and AccessPoint drive: wireless
+    interfaces, scanning, dhcp and the wpa_supplicant control sockets.
+    Alternative implementations, like the one in wifisetup.simulation,
+    provide the same attributes and methods. Calls into the system go
+    through the executor, so they are counted and can be recorded
+    """
+    ctrl_dir = CTRL_DIR  # wpa_supplicant control sockets
+    run_dir = config.dnsmasq_dir
+    known_networks_file = config.known_networks_file
+    bus_url = config.websocket['url']  # None to run without the messagebus
+    http_host = None  # None serves the portal on the access point address
+    http_port = 80
+
+    def interfaces(self):
+        return executor.run(['pyw', 'winterfaces'], pyw.winterfaces, [])
+
+    def set_address(self, iface, ip):
+        def inetset():
+            pyw.inetset(pyw.getcard(iface), ip)
+        executor.run(['pyw', 'inetset', iface, ip], inetset)
+
+    def create_scanner(self, iface):
+        """Object like Nl80211Scanner, None to scan with iwlist"""
+        try:
+            return CommandScanner(iface, Nl80211Scanner(iface))
+        except OSError:
+            LOG.warning('nl80211 scanning unavailable, using iwlist')
+            return None
+
+    def create_event_listener(self, iface):
+        """WpaEventDispatcher to start, raises OSError without events"""
+        if executor.recording:
+            return RecordingEventListener(iface, self.ctrl_dir)
+        return WpaEventListener(iface, self.ctrl_dir)
+
+    def start_dhcp(self, ap):
+        ap.start_dnsmasq()
+
+    def stop_dhcp(self, ap):
+        ap.stop_dnsmasq()
+
+    def close(self):
+        pass
+
+
+class ReplayBackend(SystemBackend):
+    """
+    Serve a session recorded with WIFISETUP_RECORD from WIFISETUP_REPLAY,
+    without wifi hardware or root. Commands, wpa requests, interfaces,
+    scans, neighbour table queries and wpa events are replayed. Not
+    replayed: the dnsmasq lease file, which stays empty, neighbour table
+    events, which come from the replaying machine, and the portal's
+    messages, which come from whoever opens http://127.0.0.1:8080/
+    """
+    bus_url = None
+    http_host = '127.0.0.1'
+    http_port = REPLAY_HTTP_PORT
+
+    def __init__(self):
+        self.dir = tempfile.mkdtemp(prefix='wifisetup-replay-')
+        self.run_dir = join(self.dir, 'run')
+        self.known_networks_file = join(self.dir, 'known_networks.json')
+
+    def create_scanner(self, iface):
+        return CommandScanner(iface)  # without recorded scans, iwlist ones
+
+    def create_event_listener(self, iface):
+        entry = executor.replayed(['wpa_events', iface])
+        if entry is None:
+            raise OSError('No wpa events recorded for ' + iface)
+        return ReplayedEventListener(iface, entry['result'])
+
+    def start_dhcp(self, ap):
+        pass
+
+    def stop_dhcp(self, ap):
+        pass
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def create_backend():
+    """ReplayBackend when WIFISETUP_REPLAY is set, else SystemBackend"""
+    return ReplayBackend() if executor.replaying else SystemBackend()
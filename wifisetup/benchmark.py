@@ -0,0 +1,228 @@
+# Copyright 2017 Mycroft AI, Inc.
+#
+# This file is part of Mycroft Wifi Setup.
+#
+# Mycroft Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mycroft Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mycroft Core.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Run complete setup sessions on the simulated backend, through the real
+WebServer and portal websocket, and report latency percentiles per phase:
+    python3 -m wifisetup.benchmark --sessions 20 --networks 40
+
+Phases:
+    ap_up: WifiClient created until the ap_up event
+    page_load: portal page fetched and its websocket opened
+    network_list: wifi.scan sent until the page listed every network
+    connected: wifi.connect sent until a successful connection.status
+    teardown: wifi.stop sent until the access point group was removed
+"""
+import argparse
+import http.client
+import json
+import logging
+import math
+import os
+from threading import Condition, Thread
+from time import monotonic
+
+from websocket import create_connection
+
+from wifisetup.simulation import CORRECT_PASSWORD, SimulatedBackend
+from wifisetup.util import EVENT_FD_ENV
+from wifisetup.wifi_client import WifiClient
+
+LOG = logging.getLogger(__name__)
+
+PHASES = ['ap_up', 'page_load', 'network_list', 'connected', 'teardown']
+TIMEOUT = 30
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of a non empty list"""
+    values = sorted(values)
+    return values[max(math.ceil(pct / 100 * len(values)) - 1, 0)]
+
+
+class EventLog(Thread):
+    """ Collect the structured events WifiClient writes to the event pipe """
+
+    def __init__(self):
+        super(EventLog, self).__init__(daemon=True)
+        read_fd, write_fd = os.pipe()
+        os.environ[EVENT_FD_ENV] = str(write_fd)
+        self.file = open(read_fd, 'rb')
+        self.events = []
+        self.cond = Condition()
+
+    def run(self):
+        for line in self.file:
+            with self.cond:
+                self.events.append(json.loads(line))
+                self.cond.notify_all()
+
+    def wait(self, name, since, timeout=TIMEOUT):
+        """Timestamp of the first event called name at or after since"""
+        def find():
+            return next((e['ts'] for e in self.events
+                         if e['event'] == name and e['ts'] >= since), None)
+        with self.cond:
+            ts = self.cond.wait_for(find, timeout)
+        if ts is None:
+            raise RuntimeError('No %s event within %ss' % (name, timeout))
+        return ts
+
+
+class Portal:
+    """ What the phone's browser does: load the page, then use its websocket """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.ws = None
+        self.networks = {}
+
+    def load(self):
+        conn = http.client.HTTPConnection(self.host, self.port,
+                                          timeout=TIMEOUT)
+        for path in ['/', '/js/Config.js', '/js/WS.js', '/js/main.js']:
+            conn.request('GET', path, headers={
+                'Host': 'start.mycroft.ai', 'Accept-Encoding': 'gzip'
+            })
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                raise RuntimeError('GET %s returned %d' %
+                                   (path, response.status))
+        conn.close()
+        self.ws = create_connection(
+            'ws://%s:%d/wifi' % (self.host, self.port),
+            header=['Host: start.mycroft.ai'], timeout=TIMEOUT)
+
+    def send(self, name, data=None):
+        self.ws.send(json.dumps({'type': name, 'data': data or {}}))
+
+    def wait_for(self, name):
+        """Data of the next message called name, unpacking batches"""
+        while True:
+            message = json.loads(self.ws.recv())
+            if message['type'] == 'wifi.batch':
+                messages = message['data']['messages']
+            else:
+                messages = [message]
+            for message in messages:
+                if message['type'] == name:
+                    return message['data']
+
+    def wait_for_networks(self, count):
+        """Apply wifi.scanned lists and deltas like main.js until complete"""
+        while True:
+            data = self.wait_for('wifi.scanned')
+            if 'networks' in data:
+                self.networks = dict(data['networks'])
+            else:
+                for ssid in data['removed']:
+                    self.networks.pop(ssid, None)
+                self.networks.update(data['added'])
+                self.networks.update(data['changed'])
+            if len(self.networks) >= count:
+                return self.networks
+
+    def close(self):
+        if self.ws:
+            self.ws.close()
+
+
+def run_session(args, events, number):
+    """Returns: {phase: seconds}"""
+    backend = SimulatedBackend(args.networks, args.scan_delay,
+                               args.connect_delay, args.dhcp_delay)
+    timings = {}
+    start = monotonic()
+    client = WifiClient(allow_timeout=False, backend=backend)
+    portal = None
+    try:
+        timings['ap_up'] = events.wait('ap_up', start) - start
+
+        backend.join_station('02:00:00:00:01:%02x' % (number % 256),
+                             '172.24.1.%d' % (50 + number % 100), 'phone')
+        portal = Portal(*client.server.server.server_address[:2])
+        start = monotonic()
+        portal.load()
+        timings['page_load'] = monotonic() - start
+
+        start = monotonic()
+        portal.send('wifi.scan')
+        networks = portal.wait_for_networks(args.networks)
+        timings['network_list'] = monotonic() - start
+
+        ssid = max(networks, key=lambda k: networks[k]['quality'])
+        start = monotonic()
+        portal.send('wifi.connect', {'ssid': ssid,
+                                     'password': CORRECT_PASSWORD})
+        status = portal.wait_for('connection.status')
+        if not status['connected']:
+            raise RuntimeError('Connecting failed: %s' % status['reason'])
+        timings['connected'] = monotonic() - start
+
+        start = monotonic()
+        portal.send('wifi.stop')
+        if not backend.wpa.group_removed.wait(TIMEOUT):
+            raise RuntimeError('Access point was not removed')
+        timings['teardown'] = backend.wpa.group_removed_at - start
+    finally:
+        if portal:
+            portal.close()
+        if client.running:
+            client.close()
+    return timings
+
+
+def report(results, failures):
+    print('%-14s %6s %9s %9s %9s %9s' % ('phase (ms)', 'n', 'p50', 'p90',
+                                         'p99', 'max'))
+    for phase in PHASES:
+        values = [r[phase] * 1000 for r in results if phase in r]
+        if not values:
+            continue
+        print('%-14s %6d %9.1f %9.1f %9.1f %9.1f' % (
+            phase, len(values), percentile(values, 50),
+            percentile(values, 90), percentile(values, 99), max(values)))
+    print('%d sessions, %d failed' % (len(results) + failures, failures))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sessions', type=int, default=10)
+    parser.add_argument('--networks', type=int, default=20)
+    parser.add_argument('--scan-delay', type=float, default=0.5)
+    parser.add_argument('--connect-delay', type=float, default=0.3)
+    parser.add_argument('--dhcp-delay', type=float, default=0.2)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else
+                        logging.WARNING)
+
+    events = EventLog()
+    events.start()
+    results, failures = [], 0
+    for number in range(args.sessions):
+        try:
+            results.append(run_session(args, events, number))
+        except Exception:
+            LOG.exception('Session %d failed', number)
+            failures += 1
+    report(results, failures)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,10 +19,29 @@ server_url = "http://start.mycroft.ai"
 ssid = "MYCROFT"
 password = "12345678"
 device_name = "mycroft-holmes-i"
+scan_cache_ttl = 30  # seconds a wifi scan is answered from memory
+scan_refresh_interval = 20  # seconds between background scans
+http_max_connections = 16  # portal connections served at once
+http_timeout = 5  # seconds an idle keep-alive connection is held open
+asset_cache_limit = 4 * 1024 * 1024  # bytes of web files kept in memory
+asset_max_age = 3600  # seconds browsers may reuse css, js and images
+connect_timeout = 20  # seconds to wait for wpa_supplicant to connect
+dhcp_timeout = 5  # seconds to wait for an address once connected
+known_networks_file = '/var/lib/mycroft-wifi-setup/known_networks.json'
+pin_known_bssid = False  # also lock reconnects to the last access point
+dnsmasq_dir = '/run/mycroft-wifi-setup'  # config, pid and leases of dnsmasq
+dns_server = False  # answer dns in process, leaving only dhcp to dnsmasq
+log_level = 'INFO'  # records written to stderr
+log_ring_level = 'DEBUG'  # records kept in memory, written after an error
+log_ring_size = 500  # number of recent records kept in memory
+log_levels = {}  # per module overrides, like {'wifisetup.web_server': 'INFO'}
 
+portal_websocket_route = '/wifi'  # websocket of the portal page
+
+# Messagebus of mycroft-core, only used on the device itself
 websocket = {
     'protocol': 'ws://',
-    'host': '172.24.1.1',
+    'host': '127.0.0.1',
     'port': 8181,
     'route': '/core'
 }
@@ -0,0 +1,124 @@
+# Copyright 2017 Mycroft AI, Inc.
+#
+# This file is part of Mycroft Wifi Setup.
+#
+# Mycroft Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mycroft Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mycroft Core.  If not, see <http://www.gnu.org/licenses/>.
+from logging import getLogger
+from threading import Event
+from time import monotonic
+
+LOG = getLogger(__name__)
+
+
+def event_network_id(args):
+    """Network id in 'id=3' or '[id=3' event arguments, None without one"""
+    for arg in args:
+        name, _, value = arg.lstrip('[').partition('=')
+        if name == 'id':
+            return value.rstrip(']')
+    return None
+
+
+class ConnectionAttempt:
+    """
+    Follow one connection attempt through the station's wpa_supplicant
+    events, from a WpaEventDispatcher that is not started yet. Resolves as
+    soon as the outcome is known and records when each phase (scan, auth,
+    assoc, handshake, connected, dhcp) was reached. Outcome events naming
+    another network id than nid are ignored
+
+    Usage:
+        >>> attempt = ConnectionAttempt(WpaEventListener('wlan0'), '3')
+        >>> # ... enable the network ...
+        >>> attempt.wait(20), attempt.reason, attempt.timeline
+        (False, 'wrong_key', {'scan': 0.004, 'auth': 1.2, 'assoc': 1.25})
+    """
+    def __init__(self, listener, nid):
+        self.nid = str(nid)
+        self.start = monotonic()
+        self.timeline = {}
+        self.connected = False
+        self.reason = None
+        self.done = Event()
+        self.listener = listener
+        for name, handler in [
+            ('CTRL-EVENT-SCAN-STARTED', lambda _: self.mark('scan')),
+            ('SME:', self.on_progress),
+            ('Trying', self.on_progress),
+            ('Associated', lambda _: self.mark('assoc')),
+            ('WPA:', self.on_wpa),
+            ('CTRL-EVENT-CONNECTED', self.on_connected),
+            ('CTRL-EVENT-SSID-TEMP-DISABLED', self.on_temp_disabled),
+            ('CTRL-EVENT-NETWORK-NOT-FOUND',
+             lambda _: self.finish(False, 'not_found')),
+            ('CTRL-EVENT-ASSOC-REJECT',
+             lambda _: self.finish(False, 'assoc_rejected')),
+            ('CTRL-EVENT-AUTH-REJECT',
+             lambda _: self.finish(False, 'auth_rejected'))
+        ]:
+            self.listener.on(name, handler)
+        self.listener.start()
+
+    def mark(self, phase):
+        """Record the first time a phase was reached, in seconds"""
+        self.timeline.setdefault(phase, round(monotonic() - self.start, 3))
+
+    def finish(self, connected, reason=None):
+        if not self.done.is_set():
+            self.connected = connected
+            self.reason = reason
+            self.done.set()
+
+    def on_progress(self, args):
+        """'SME: Trying to authenticate ...' or 'Trying to associate ...'"""
+        if 'authenticate' in args or 'associate' in args:
+            self.mark('auth')
+
+    def on_wpa(self, args):
+        if ' '.join(args).startswith('Key negotiation completed'):
+            self.mark('handshake')
+
+    def is_other_network(self, args):
+        nid = event_network_id(args)
+        if nid is not None and nid != self.nid:
+            LOG.debug('Ignoring event of network %s', nid)
+            return True
+        return False
+
+    def on_connected(self, args):
+        if self.is_other_network(args):
+            return
+        self.mark('connected')
+        self.finish(True)
+
+    def on_temp_disabled(self, args):
+        if self.is_other_network(args):
+            return
+        reason = dict(a.partition('=')[::2] for a in args).get('reason', '')
+        self.finish(False, 'wrong_key' if reason == 'WRONG_KEY' else
+                    reason.lower() or 'disabled')
+
+    def wait(self, timeout):
+        """True once connected, False on failure or timeout"""
+        if not self.done.wait(timeout):
+            self.finish(False, 'timeout')
+        LOG.info('Connection attempt: connected=%s reason=%s timeline=%s',
+                 self.connected, self.reason, self.timeline)
+        return self.connected
+
+    def cancel(self):
+        self.finish(False, 'cancelled')
+
+    def close(self):
+        self.listener.stop()
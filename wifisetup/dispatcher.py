@@ -0,0 +1,98 @@
+# Copyright 2017 Mycroft AI, Inc.
+#
+# This file is part of Mycroft Wifi Setup.
+#
+# Mycroft Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mycroft Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mycroft Core.  If not, see <http://www.gnu.org/licenses/>.
+from logging import getLogger
+from queue import Queue
+from threading import Lock, Thread
+
+LOG = getLogger(__name__)
+
+
+class Dispatcher:
+    """
+    Run portal commands off the websocket receive thread. Every queue has
+    its own worker, so a connect does not hold up a scan and neither holds
+    up wifi.cancel
+
+    Usage:
+        >>> dispatcher = Dispatcher()
+        >>> dispatcher.register('wifi.scan', scan, queue='scan', coalesce=True)
+        >>> dispatcher.register('wifi.cancel', cancel, preempt=True)
+        >>> dispatcher.dispatch('wifi.scan', {})
+        True
+    """
+    def __init__(self):
+        self.routes = {}
+        self.queues = {}
+        self.pending = set()  # coalesced commands that are queued or running
+        self.lock = Lock()
+        self.generation = 0  # bumped to invalidate everything queued so far
+        self.running = True
+
+    def register(self, name, handler, queue=None, coalesce=False,
+                 preempt=False):
+        """
+        queue: worker to run on, None runs on the caller's thread
+        coalesce: ignore the command while the same one is queued or running
+        preempt: drop all queued work before running
+        """
+        self.routes[name] = (handler, queue, coalesce, preempt)
+        if queue and queue not in self.queues:
+            self.queues[queue] = Queue()
+            Thread(target=self._work, args=[self.queues[queue]],
+                   daemon=True).start()
+
+    def dispatch(self, name, data):
+        route = self.routes.get(name)
+        if not route:
+            return False
+        handler, queue, coalesce, preempt = route
+        if preempt:
+            self.cancel_pending()
+        if queue is None:
+            handler(**data)
+            return True
+        with self.lock:
+            if coalesce and name in self.pending:
+                LOG.info('Joining %s already in progress', name)
+                return True
+            self.pending.add(name)
+        self.queues[queue].put((self.generation, name, handler, data))
+        return True
+
+    def _work(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            generation, name, handler, data = item
+            try:
+                if self.running and generation == self.generation:
+                    handler(**data)
+            except:
+                LOG.exception('Error handling ' + name)
+            finally:
+                with self.lock:
+                    self.pending.discard(name)
+
+    def cancel_pending(self):
+        """Skip queued commands, running ones finish on their own"""
+        self.generation += 1
+
+    def stop(self):
+        self.running = False
+        for queue in self.queues.values():
+            queue.put(None)
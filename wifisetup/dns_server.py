@@ -0,0 +1,186 @@
+# Copyright 2017 Mycroft AI, Inc.
+#
+# This file is part of Mycroft Wifi Setup.
+#
+# Mycroft Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mycroft Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mycroft Core.  If not, see <http://www.gnu.org/licenses/>.
+import asyncio
+import socket
+import struct
+from collections import Counter
+from logging import getLogger
+from threading import Thread
+
+LOG = getLogger(__name__)
+
+HEADER = struct.Struct('!HHHHHH')
+ANSWER = struct.Struct('!HHHIH')
+QTYPE_A = 1
+QTYPE_AAAA = 28
+CLASS_IN = 1
+FLAG_RD = 0x0100
+OPCODE_MASK = 0x7800
+RESPONSE_FLAGS = 0x8400  # response, authoritative
+RCODE_NOTIMP = 4
+NAME_POINTER = 0xc00c  # the name of the question right after the header
+
+TTL = 10
+PROBE_TTL = 0  # never let a device cache a connectivity check answer
+CACHE_SIZE = 512
+
+# Hosts resolved by the connectivity checks of each OS
+PROBE_HOSTS = {
+    b'connectivitycheck.gstatic.com': 'android',
+    b'connectivitycheck.android.com': 'android',
+    b'clients3.google.com': 'android',
+    b'www.google.com': 'android',
+    b'captive.apple.com': 'apple',
+    b'www.apple.com': 'apple',
+    b'www.msftconnecttest.com': 'windows',
+    b'www.msftncsi.com': 'windows',
+    b'dns.msftncsi.com': 'windows',
+    b'detectportal.firefox.com': 'firefox',
+    b'spectrum.s3.amazonaws.com': 'kindle'
+}
+
+
+def parse_question(data):
+    """
+    Split a query into its header fields and single question
+    Returns: (txid, flags, qname, qtype, qclass, end of question)
+    Raises: ValueError if the packet is malformed
+    """
+    if len(data) < HEADER.size:
+        raise ValueError('Short packet')
+    txid, flags, qdcount = HEADER.unpack_from(data)[:3]
+    if qdcount != 1:
+        raise ValueError('Expected one question, got %d' % qdcount)
+    idx = HEADER.size
+    while True:
+        if idx >= len(data):
+            raise ValueError('Truncated name')
+        size = data[idx]
+        if size == 0:
+            break
+        if size > 63:
+            raise ValueError('Compressed or invalid label')
+        idx += size + 1
+    qname = data[HEADER.size:idx + 1]
+    if idx + 5 > len(data):
+        raise ValueError('Truncated question')
+    qtype, qclass = struct.unpack_from('!HH', data, idx + 1)
+    return txid, flags, qname, qtype, qclass, idx + 5
+
+
+def decode_name(qname):
+    """b'\\x03www\\x07example\\x03com\\x00' -> b'www.example.com'"""
+    labels, idx = [], 0
+    while qname[idx]:
+        labels.append(qname[idx + 1:idx + 1 + qname[idx]])
+        idx += qname[idx] + 1
+    return b'.'.join(labels).lower()
+
+
+class DnsProtocol(asyncio.DatagramProtocol):
+    """
+    Answer every A query with the portal's address. AAAA and other types
+    get an empty answer so clients fall back to IPv4. Responses are cached
+    per question without the transaction id, which is patched in per query
+    """
+    def __init__(self, ip):
+        self.address = socket.inet_aton(ip)
+        self.transport = None
+        self.cache = {}
+        self.clients = Counter()
+        self.probe_hits = Counter()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.clients[addr[0]] += 1
+        try:
+            txid, flags, qname, qtype, qclass, end = parse_question(data)
+        except ValueError:
+            LOG.debug('Ignoring bad query from %s', addr[0])
+            return
+        if flags & OPCODE_MASK:
+            self.transport.sendto(self.error(data, end, RCODE_NOTIMP), addr)
+            return
+        key = (qname, qtype, qclass, flags & FLAG_RD)
+        response = self.cache.get(key)
+        if response is None:
+            response = self.build(data[HEADER.size:end], qname, qtype,
+                                  qclass, flags & FLAG_RD)
+            if len(self.cache) >= CACHE_SIZE:
+                self.cache.clear()
+            self.cache[key] = response
+        probe = PROBE_HOSTS.get(decode_name(qname))
+        if probe:
+            self.probe_hits[probe] += 1
+        self.transport.sendto(struct.pack('!H', txid) + response, addr)
+
+    def build(self, question, qname, qtype, qclass, rd):
+        """Encoded response without its leading transaction id"""
+        answer = b''
+        if qtype == QTYPE_A and qclass == CLASS_IN:
+            ttl = PROBE_TTL if decode_name(qname) in PROBE_HOSTS else TTL
+            answer = ANSWER.pack(NAME_POINTER, QTYPE_A, CLASS_IN, ttl,
+                                 len(self.address)) + self.address
+        header = HEADER.pack(0, RESPONSE_FLAGS | rd, 1, int(bool(answer)),
+                             0, 0)
+        return header[2:] + question + answer
+
+    @staticmethod
+    def error(data, end, rcode):
+        txid, flags = struct.unpack_from('!HH', data)
+        flags = (flags & (OPCODE_MASK | FLAG_RD)) | 0x8000 | rcode
+        return HEADER.pack(txid, flags, 1, 0, 0, 0) + data[HEADER.size:end]
+
+    def stats(self):
+        return {
+            'queries': sum(self.clients.values()),
+            'clients': dict(self.clients),
+            'probes': dict(self.probe_hits),
+            'cached': len(self.cache)
+        }
+
+
+class DnsServer(Thread):
+    """ Wildcard DNS for devices connected to the temporary access point """
+
+    def __init__(self, ip, port=53):
+        super(DnsServer, self).__init__()
+        self.daemon = True
+        self.loop = asyncio.new_event_loop()
+        self.protocol = DnsProtocol(ip)
+        try:
+            self.transport, _ = self.loop.run_until_complete(
+                self.loop.create_datagram_endpoint(lambda: self.protocol,
+                                                   local_addr=(ip, port)))
+        except OSError:
+            self.loop.close()
+            raise RuntimeError('Could not create dns server! Port already in use.')
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.transport.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join(0.5)
+        LOG.info('Dns server stats: %s', self.protocol.stats())
+
+    def run(self):
+        LOG.info("Starting Dns Server at %s:%s" %
+                 self.transport.get_extra_info('sockname')[:2])
+        self.loop.run_forever()
+        self.loop.close()
+        LOG.info("Dns Server stopped!")
@@ -0,0 +1,71 @@
+# Copyright 2017 Mycroft AI, Inc.
+#
+# This file is part of Mycroft Wifi Setup.
+#
+# Mycroft Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mycroft Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mycroft Core.  If not, see <http://www.gnu.org/licenses/>.
+import json
+import os
+import time
+from logging import getLogger
+from os.path import dirname
+from threading import Lock
+
+LOG = getLogger(__name__)
+
+
+class KnownNetworks:
+    """
+    Networks this device joined before, persisted as JSON:
+        {ssid: {bssid, freq, security, connect_time, last_seen}}
+
+    Usage:
+        >>> known = KnownNetworks('/tmp/known_networks.json')
+        >>> known.remember('home', '02:00:00:00:00:01', 2437, 'WPA2-PSK', 0.8)
+        >>> known.get('home')['freq']
+        2437
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.networks = {}
+        try:
+            with open(path) as f:
+                self.networks = json.load(f)
+        except (OSError, ValueError):
+            LOG.debug('No known networks at ' + path)
+
+    def get(self, ssid):
+        return self.networks.get(ssid)
+
+    def remember(self, ssid, bssid, freq, security, connect_time):
+        with self.lock:
+            self.networks[ssid] = {
+                'bssid': bssid,
+                'freq': freq,
+                'security': security,
+                'connect_time': connect_time,
+                'last_seen': int(time.time())
+            }
+            self.save()
+
+    def save(self):
+        """Write atomically so a power cut never leaves a truncated file"""
+        tmp = self.path + '.tmp'
+        try:
+            os.makedirs(dirname(self.path), exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(self.networks, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            LOG.exception('Could not save known networks')
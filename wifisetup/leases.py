@@ -0,0 +1,186 @@
+# Copyright 2017 Mycroft AI, Inc.
+#
+# This file is part of Mycroft Wifi Setup.
+#
+# Mycroft Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mycroft Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mycroft Core.  If not, see <http://www.gnu.org/licenses/>.
+import ctypes
+import ctypes.util
+import os
+import struct
+import time
+from logging import getLogger
+from os.path import basename, dirname
+from select import select
+from threading import Thread
+
+LOG = getLogger(__name__)
+
+LEASE_FILE = '/var/lib/misc/dnsmasq.leases'
+
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')
+SETTLE_TIME = 0.05  # dnsmasq truncates then rewrites the whole file
+
+
+def parse_leases(text):
+    """
+    Parse dnsmasq lease lines of the form
+    '<expiry> <mac> <ip> <hostname> <client id>' into a table keyed by MAC
+    """
+    table = {}
+    for line in text.split('\n'):
+        parts = line.split()
+        if len(parts) < 4 or not parts[0].isdigit():
+            continue  # blank or half written line
+        table[parts[1]] = {
+            'mac': parts[1],
+            'ip': parts[2],
+            'hostname': '' if parts[3] == '*' else parts[3],
+            'expiry': int(parts[0])
+        }
+    return table
+
+
+class Inotify:
+    """Minimal ctypes binding of the inotify syscalls"""
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, path.encode(), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'Cannot watch ' + path)
+        return wd
+
+    def read(self, timeout):
+        """Names of the files that changed, empty if timeout passed first"""
+        if not select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 4096)
+        names, idx = [], 0
+        while idx < len(data):
+            _, _, _, size = EVENT_HEADER.unpack_from(data, idx)
+            idx += EVENT_HEADER.size
+            names.append(data[idx:idx + size].rstrip(b'\0').decode())
+            idx += size
+        return names
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class LeaseWatcher(Thread):
+    """
+    Watch the dnsmasq lease file and emit per client events:
+        join: a new MAC got a lease
+        renew: the expiry of a known lease changed
+        expire: a lease was dropped from the file or ran out
+
+    Usage:
+        >>> watcher = LeaseWatcher()
+        >>> watcher.on('join', lambda lease: print(lease['hostname']))
+        >>> watcher.start()
+    """
+    def __init__(self, path=LEASE_FILE, poll_interval=5):
+        super(LeaseWatcher, self).__init__(daemon=True)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.running = True
+        self.handlers = {}
+        self.leases = {}
+        self.last_mod = None
+        try:
+            self.inotify = Inotify()
+            self.inotify.watch(dirname(path), IN_MODIFY | IN_CLOSE_WRITE |
+                               IN_MOVED_TO | IN_CREATE | IN_DELETE)
+        except (OSError, AttributeError, TypeError):
+            LOG.warning('inotify unavailable, polling ' + path)
+            self.inotify = None
+        self.leases = self.read_leases()
+
+    def on(self, event, handler):
+        self.handlers.setdefault(event, []).append(handler)
+
+    def emit(self, event, lease):
+        LOG.info('Lease %s: %s', event, lease)
+        for handler in self.handlers.get(event, []):
+            try:
+                handler(lease)
+            except:
+                LOG.exception('Error handling lease ' + event)
+
+    def read_leases(self):
+        try:
+            with open(self.path) as f:
+                self.last_mod = os.fstat(f.fileno()).st_mtime
+                return parse_leases(f.read())
+        except OSError:
+            self.last_mod = None
+            return {}
+
+    def update(self):
+        """Re-read the lease file and emit the differences"""
+        old, new = self.leases, self.read_leases()
+        self.leases = new
+        for mac, lease in new.items():
+            if mac not in old:
+                self.emit('join', lease)
+            elif old[mac]['expiry'] != lease['expiry']:
+                self.emit('renew', lease)
+        for mac in set(old) - set(new):
+            self.emit('expire', old[mac])
+
+    def expire_stale(self):
+        now = time.time()
+        for mac, lease in list(self.leases.items()):
+            if 0 < lease['expiry'] < now:
+                del self.leases[mac]
+                self.emit('expire', lease)
+
+    def wait_for_change(self):
+        if self.inotify:
+            if basename(self.path) not in self.inotify.read(self.poll_interval):
+                return False
+            while self.inotify.read(SETTLE_TIME):
+                pass  # let a rewrite in progress finish before parsing
+            return True
+        time.sleep(self.poll_interval)
+        try:
+            return os.path.getmtime(self.path) != self.last_mod
+        except OSError:
+            return self.last_mod is not None
+
+    def run(self):
+        while self.running:
+            if self.wait_for_change():
+                self.update()
+            self.expire_stale()
+        if self.inotify:
+            self.inotify.close()
+
+    def stop(self):
+        """Ask the thread to exit, it closes inotify on its next wake up"""
+        self.running = False
+        if self.inotify and not self.is_alive():
+            self.inotify.close()
@@ -0,0 +1,95 @@
+# Copyright 2017 Mycroft AI, Inc.
+#
+# This file is part of Mycroft Wifi Setup.
+#
+# Mycroft Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mycroft Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mycroft Core.  If not, see <http://www.gnu.org/licenses/>.
+import atexit
+import logging
+import sys
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
+from threading import Lock
+
+from wifisetup import config
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    Keep the most recent records in memory. When an error is logged, the
+    kept records that were too detailed to be written are sent to the
+    writer first, so the error arrives with its context
+    """
+    def __init__(self, writer, written_level, size):
+        super(RingBufferHandler, self).__init__()
+        self.writer = writer
+        self.written_level = written_level
+        self.records = deque(maxlen=size)
+        self.dump_lock = Lock()
+
+    def emit(self, record):
+        if record.levelno >= logging.ERROR:
+            self.dump()
+        self.records.append(record)
+
+    def dump(self):
+        """Write out the kept records that were not written already"""
+        with self.dump_lock:
+            records = [r for r in self.records
+                       if r.levelno < self.written_level]
+            self.records.clear()
+        if records:
+            self.writer.enqueue(self.writer.prepare(logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.INFO,
+                'levelname': 'INFO',
+                'msg': 'Last %d unwritten log records:' % len(records)
+            })))
+        for record in records:
+            self.writer.enqueue(self.writer.prepare(record))
+
+
+def setup_logging(level=config.log_level, ring_level=config.log_ring_level,
+                  ring_size=config.log_ring_size,
+                  module_levels=config.log_levels):
+    """
+    Log through a queue so that callers never wait for stderr. Records of
+    at least `level` are written by a background thread, the ones between
+    `ring_level` and `level` are only kept in the ring buffer
+
+    Returns: the RingBufferHandler, to dump on demand
+    """
+    level = logging.getLevelName(level)
+    ring_level = logging.getLevelName(ring_level)
+
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(logging.Formatter(FORMAT))
+    queue = Queue()
+    listener = QueueListener(queue, stream)
+    writer = QueueHandler(queue)
+    writer.setLevel(level)
+    ring = RingBufferHandler(writer, level, ring_size)
+    ring.setLevel(ring_level)
+
+    root = logging.getLogger()
+    root.setLevel(min(level, ring_level))
+    root.addHandler(ring)  # before the writer so context precedes errors
+    root.addHandler(writer)
+    for name, module_level in module_levels.items():
+        logging.getLogger(name).setLevel(module_level)
+
+    listener.start()
+    atexit.register(listener.stop)  # writes what is still queued
+    return ring
@@ -34,18 +34,11 @@ sys.path += ['.']  # noqa
 import logging
 from subprocess import call
 from wifisetup.wifi_client import WifiClient
+from wifisetup.logs import setup_logging
 from wifisetup.util import trigger_event
 from wifisetup import config
 
-root = logging.getLogger()
-root.setLevel(logging.DEBUG)
-
-ch = logging.StreamHandler(sys.stderr)
-ch.setLevel(logging.DEBUG)
-formatter = logging.Formatter(
-                '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-ch.setFormatter(formatter)
-root.addHandler(ch)
+setup_logging()
 
 LOG = logging.getLogger(__name__)
 
@@ -78,7 +71,7 @@ def run_wifi(allow_timeout='True'):
         client.join()
     except:
         LOG.exception('Error running wifi client')
-        trigger_event('ap_error')
+        trigger_event('ap_error', {'error': repr(sys.exc_info()[1])}, 'main')
 
 
 def reset_wifi():
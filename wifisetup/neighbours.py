@@ -0,0 +1,232 @@
+# Copyright 2017 Mycroft AI, Inc.
+#
+# This file is part of Mycroft Wifi Setup.
+#
+# Mycroft Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mycroft Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mycroft Core.  If not, see <http://www.gnu.org/licenses/>.
+import socket
+import struct
+from ipaddress import ip_address, ip_network
+from itertools import count
+from logging import getLogger
+from threading import Lock, Thread
+
+from wifisetup.util import executor
+
+LOG = getLogger(__name__)
+
+NETLINK_ROUTE = 0
+RTMGRP_NEIGH = 0x4
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+RTM_GETNEIGH = 30
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NDA_DST = 1
+NDA_LLADDR = 2
+
+NUD_INCOMPLETE = 0x01
+NUD_REACHABLE = 0x02
+NUD_STALE = 0x04
+NUD_DELAY = 0x08
+NUD_PROBE = 0x10
+NUD_FAILED = 0x20
+NUD_NOARP = 0x40
+NUD_PERMANENT = 0x80
+NUD_UNRESOLVED = NUD_INCOMPLETE | NUD_FAILED  # what arp -n calls incomplete
+
+NLMSGHDR = struct.Struct('=IHHII')
+NDMSG = struct.Struct('=BxxxiHBB')
+RTATTR = struct.Struct('=HH')
+
+PROBE_PORT = 9  # discard, only the ARP request matters
+
+
+def align(size):
+    return (size + 3) & ~3
+
+
+def parse_neighbour(data):
+    """Decode the ndmsg payload of a RTM_*NEIGH message"""
+    family, ifindex, state, _, _ = NDMSG.unpack_from(data)
+    entry = {'ifindex': ifindex, 'state': state, 'ip': None, 'mac': None}
+    idx = NDMSG.size
+    while idx + RTATTR.size <= len(data):
+        size, kind = RTATTR.unpack_from(data, idx)
+        if size < RTATTR.size:
+            break
+        value = data[idx + RTATTR.size:idx + size]
+        if kind == NDA_DST and family == socket.AF_INET:
+            entry['ip'] = socket.inet_ntoa(value)
+        elif kind == NDA_LLADDR:
+            entry['mac'] = ':'.join('%02x' % b for b in value)
+        idx += align(size)
+    return entry
+
+
+def parse_messages(data):
+    """Yield (type, payload) for each netlink message in a datagram"""
+    idx = 0
+    while idx + NLMSGHDR.size <= len(data):
+        size, kind, _, _, _ = NLMSGHDR.unpack_from(data, idx)
+        if size < NLMSGHDR.size:
+            break
+        yield kind, data[idx + NLMSGHDR.size:idx + size]
+        idx += align(size)
+
+
+class NeighbourTable:
+    """
+    Read and modify the kernel IPv4 neighbour (ARP) table over netlink
+
+    Usage:
+        >>> table = NeighbourTable()
+        >>> table.is_reachable('172.24.1.0/24')
+        True
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.seq = count(1)
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                  NETLINK_ROUTE)
+        self.sock.bind((0, 0))
+        self.sock.settimeout(2)
+        self.probe_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.probe_sock.setblocking(False)
+
+    def close(self):
+        self.sock.close()
+        self.probe_sock.close()
+
+    def request(self, kind, flags, payload):
+        """Send a request and collect replies until it is done"""
+        with self.lock:
+            seq = next(self.seq)
+            header = NLMSGHDR.pack(NLMSGHDR.size + len(payload), kind,
+                                   NLM_F_REQUEST | flags, seq, 0)
+            self.sock.send(header + payload)
+            replies = []
+            while True:
+                for msg_type, data in parse_messages(self.sock.recv(65536)):
+                    if msg_type == NLMSG_DONE:
+                        return replies
+                    if msg_type == NLMSG_ERROR:
+                        error = struct.unpack_from('=i', data)[0]
+                        if error:
+                            raise OSError(-error, 'Netlink request failed')
+                        return replies
+                    replies.append(data)
+
+    def dump(self):
+        """All IPv4 neighbour entries as dicts of ip, mac, ifindex, state"""
+        payload = NDMSG.pack(socket.AF_INET, 0, 0, 0, 0)
+        replies = self.request(RTM_GETNEIGH, NLM_F_DUMP, payload)
+        return [parse_neighbour(data) for data in replies]
+
+    def entries(self, subnet):
+        network = ip_network(subnet)
+        return [entry for entry in self.dump()
+                if entry['ip'] and ip_address(entry['ip']) in network]
+
+    def delete(self, entry):
+        attr = socket.inet_aton(entry['ip'])
+        payload = (NDMSG.pack(socket.AF_INET, entry['ifindex'], 0, 0, 0) +
+                   RTATTR.pack(RTATTR.size + len(attr), NDA_DST) + attr)
+        self.request(RTM_DELNEIGH, NLM_F_ACK, payload)
+
+    def flush(self, subnet):
+        """Drop every entry of the subnet so devices must re-register"""
+        executor.run(['rtnetlink', 'flush', subnet],
+                     lambda: self._flush(subnet))
+
+    def _flush(self, subnet):
+        for entry in self.entries(subnet):
+            if not entry['state'] & (NUD_PERMANENT | NUD_NOARP):
+                try:
+                    self.delete(entry)
+                except OSError as e:
+                    LOG.debug('Could not flush %s: %s', entry['ip'], e)
+
+    def probe(self, ip):
+        """Make the kernel send an ARP request without waiting on a reply"""
+        try:
+            self.probe_sock.sendto(b'', (ip, PROBE_PORT))
+        except OSError:
+            pass
+
+    def is_reachable(self, subnet):
+        """
+        Whether any device on the subnet has a resolved entry. Unresolved
+        entries are probed so they are fresh on the next check
+        """
+        return executor.run(['rtnetlink', 'reachable', subnet],
+                            lambda: self._is_reachable(subnet), False)
+
+    def _is_reachable(self, subnet):
+        reachable = False
+        for entry in self.entries(subnet):
+            if entry['state'] & NUD_UNRESOLVED:
+                self.probe(entry['ip'])
+            else:
+                reachable = True
+        return reachable
+
+
+class NeighbourMonitor(Thread):
+    """
+    Notify subscribers of neighbour table changes as they happen
+
+    Usage:
+        >>> monitor = NeighbourMonitor()
+        >>> monitor.subscribe(lambda event, entry: print(event, entry['ip']))
+        >>> monitor.start()
+    """
+    def __init__(self):
+        super(NeighbourMonitor, self).__init__(daemon=True)
+        self.running = True
+        self.subscribers = []
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                  NETLINK_ROUTE)
+        self.sock.bind((0, RTMGRP_NEIGH))
+        self.sock.settimeout(1)
+
+    def subscribe(self, handler):
+        """handler(event, entry) where event is 'new' or 'del'"""
+        self.subscribers.append(handler)
+
+    def run(self):
+        while self.running:
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                LOG.exception('Neighbour monitor socket failed')
+                break
+            for kind, payload in parse_messages(data):
+                if kind not in (RTM_NEWNEIGH, RTM_DELNEIGH):
+                    continue
+                event = 'new' if kind == RTM_NEWNEIGH else 'del'
+                entry = parse_neighbour(payload)
+                for handler in self.subscribers:
+                    try:
+                        handler(event, entry)
+                    except:
+                        LOG.exception('Error handling neighbour event')
+        self.sock.close()
+
+    def stop(self):
+        self.running = False
@@ -0,0 +1,220 @@
+# Copyright 2017 Mycroft AI, Inc.
+#
+# This file is part of Mycroft Wifi Setup.
+#
+# Mycroft Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mycroft Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mycroft Core.  If not, see <http://www.gnu.org/licenses/>.
+import base64
+import hashlib
+import json
+import socket
+import struct
+from logging import getLogger
+from select import select
+from threading import Lock
+
+LOG = getLogger(__name__)
+
+GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+MAX_MESSAGE_SIZE = 64 * 1024
+PING_INTERVAL = 20  # seconds of silence before checking the page is alive
+# Sent again to the next page that connects if no page received them
+HELD_MESSAGES = {'connection.status', 'wifi.scanned'}
+
+
+def accept_key(key):
+    """Sec-WebSocket-Accept value for a Sec-WebSocket-Key"""
+    digest = hashlib.sha1(key.encode() + GUID).digest()
+    return base64.b64encode(digest).decode()
+
+
+def encode_frame(opcode, payload):
+    """Unmasked, unfragmented frame as sent by a server"""
+    size = len(payload)
+    if size < 126:
+        header = struct.pack('!BB', 0x80 | opcode, size)
+    elif size < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, size)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, size)
+    return header + payload
+
+
+class PortalSocket:
+    """ One websocket connection from the portal page """
+
+    def __init__(self, connection, rfile, wfile):
+        self.connection = connection
+        self.rfile = rfile
+        self.wfile = wfile
+        self.lock = Lock()
+        self.closed = False
+
+    def wait_readable(self, timeout):
+        """
+        Whether a frame started arriving within timeout. Waits with select,
+        as a timed out read would leave rfile unusable
+        """
+        previous = self.connection.gettimeout()
+        self.connection.setblocking(False)
+        try:
+            buffered = self.rfile.peek(1)  # b'' if nothing is ready
+        finally:
+            self.connection.settimeout(previous)
+        return bool(buffered) or \
+            bool(select([self.connection], [], [], timeout)[0])
+
+    def read_exact(self, size):
+        data = self.rfile.read(size)
+        if len(data) < size:
+            raise ConnectionError('Websocket closed')
+        return data
+
+    def read_frame(self):
+        """
+        Returns: (fin, opcode, payload)
+        Raises: ConnectionError, also if the frame stalls past the timeout
+        """
+        try:
+            first, second = self.read_exact(2)
+            return self.read_body(first, second)
+        except socket.timeout:
+            raise ConnectionError('Websocket frame timed out')
+
+    def read_body(self, first, second):
+        size = second & 0x7f
+        if size == 126:
+            size, = struct.unpack('!H', self.read_exact(2))
+        elif size == 127:
+            size, = struct.unpack('!Q', self.read_exact(8))
+        if size > MAX_MESSAGE_SIZE:
+            raise ConnectionError('Websocket frame too large')
+        mask = self.read_exact(4) if second & 0x80 else None
+        payload = self.read_exact(size)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return first & 0x80, first & 0x0f, payload
+
+    def send(self, opcode, payload):
+        with self.lock:
+            if self.closed:
+                raise ConnectionError('Websocket closed')
+            self.wfile.write(encode_frame(opcode, payload))
+
+    def send_message(self, name, data=None):
+        message = {'type': name, 'data': data or {}}
+        self.send(OP_TEXT, json.dumps(message).encode())
+
+    def close(self):
+        try:
+            self.send(OP_CLOSE, b'')
+        except OSError:
+            pass
+        self.closed = True
+
+
+class PortalHub:
+    """
+    Websocket endpoint of the portal page, carrying only the wifi setup
+    messages between the page and the in-process WifiClient. The last
+    HELD_MESSAGES no page received are sent when a page (re)connects
+
+    Usage:
+        >>> hub = PortalHub()
+        >>> hub.on_message = lambda name, data: print(name, data)
+        >>> hub.send('wifi.scanned', {'networks': {}})  # to every open page
+    """
+    def __init__(self):
+        self.sockets = set()
+        self.lock = Lock()
+        self.held = {}
+        self.on_message = None
+
+    def send(self, name, data=None):
+        with self.lock:
+            sockets = list(self.sockets)
+        delivered = False
+        for sock in sockets:
+            try:
+                sock.send_message(name, data)
+                delivered = True
+            except OSError:
+                LOG.info('Dropping closed portal connection')
+                self.discard(sock)
+        if name in HELD_MESSAGES:
+            with self.lock:
+                if delivered:
+                    self.held.pop(name, None)
+                elif name != 'wifi.scanned' or 'networks' in data:
+                    LOG.info('No portal page connected, holding %s', name)
+                    self.held[name] = data
+
+    def discard(self, sock):
+        with self.lock:
+            self.sockets.discard(sock)
+
+    def handle(self, text):
+        try:
+            message = json.loads(text)
+            name, data = message['type'], message.get('data') or {}
+        except (ValueError, KeyError, TypeError):
+            LOG.warning('Invalid portal message: %s', text)
+            return
+        if self.on_message:
+            self.on_message(name, data)
+
+    def serve(self, sock):
+        """Read messages of one connection until it is closed"""
+        with self.lock:
+            self.sockets.add(sock)
+            held, self.held = self.held, {}
+        fragments = []
+        waiting_pong = False
+        try:
+            for name, data in held.items():
+                sock.send_message(name, data)
+            while not sock.closed:
+                if not sock.wait_readable(PING_INTERVAL):
+                    if waiting_pong:
+                        LOG.info('Portal page stopped responding')
+                        break
+                    sock.send(OP_PING, b'')
+                    waiting_pong = True
+                    continue
+                fin, opcode, payload = sock.read_frame()
+                waiting_pong = False
+                if opcode == OP_CLOSE:
+                    sock.close()
+                elif opcode == OP_PING:
+                    sock.send(OP_PONG, payload)
+                elif opcode in (OP_TEXT, OP_CONTINUATION):
+                    fragments.append(payload)
+                    if fin:
+                        self.handle(b''.join(fragments).decode())
+                        fragments = []
+        except OSError as e:
+            LOG.info('Portal connection closed: %s', e)
+        finally:
+            sock.closed = True
+            self.discard(sock)
+
+    def close(self):
+        with self.lock:
+            sockets = list(self.sockets)
+        for sock in sockets:
+            sock.close()
@@ -0,0 +1,299 @@
+# Copyright 2017 Mycroft AI, Inc.
+#
+# This file is part of Mycroft Wifi Setup.
+#
+# Mycroft Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mycroft Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mycroft Core.  If not, see <http://www.gnu.org/licenses/>.
+import errno
+import socket
+import struct
+from itertools import count
+from logging import getLogger
+from threading import Event, Lock, Thread
+from time import monotonic
+
+import pyric.net.genetlink_h as genlh
+import pyric.net.netlink_h as nlh
+import pyric.net.wireless.nl80211_h as nl80211h
+
+from wifisetup.neighbours import NLMSGHDR, RTATTR, align, parse_messages
+
+LOG = getLogger(__name__)
+
+SOL_NETLINK = 270
+NLA_TYPE_MASK = 0x3fff
+NLA_F_NESTED = 0x8000
+GENLMSGHDR = struct.Struct(genlh.genl_genlmsghdr)
+
+WLAN_CAPABILITY_PRIVACY = 0x10
+IE_SSID = 0
+IE_RSN = 48
+
+
+def pack_attr(kind, value):
+    size = RTATTR.size + len(value)
+    return RTATTR.pack(size, kind) + value + b'\0' * (align(size) - size)
+
+
+def parse_attrs(data, idx=0):
+    attrs = {}
+    while idx + RTATTR.size <= len(data):
+        size, kind = RTATTR.unpack_from(data, idx)
+        if size < RTATTR.size:
+            break
+        attrs[kind & NLA_TYPE_MASK] = data[idx + RTATTR.size:idx + size]
+        idx += align(size)
+    return attrs
+
+
+def parse_ies(data):
+    """Map information element ids to their raw bodies"""
+    ies, idx = {}, 0
+    while idx + 2 <= len(data):
+        eid, size = data[idx], data[idx + 1]
+        ies.setdefault(eid, data[idx + 2:idx + 2 + size])
+        idx += 2 + size
+    return ies
+
+
+def dbm_to_quality(dbm):
+    """Same 0-70 scale iwlist reports, normalized to 0.0-1.0"""
+    return min(max(dbm + 110, 0), 70) / 70
+
+
+def parse_bss(attrs):
+    """Decode one GET_SCAN reply, None for hidden networks"""
+    bss = parse_attrs(attrs.get(nl80211h.NL80211_ATTR_BSS, b''))
+    ies = parse_ies(bss.get(nl80211h.NL80211_BSS_INFORMATION_ELEMENTS, b''))
+    raw_ssid = ies.get(IE_SSID, b'')
+    if not raw_ssid.strip(b'\0'):
+        return None
+    capability = struct.unpack('=H', bss.get(nl80211h.NL80211_BSS_CAPABILITY,
+                                             b'\0\0'))[0]
+    signal = struct.unpack('=i', bss.get(nl80211h.NL80211_BSS_SIGNAL_MBM,
+                                         b'\0\0\0\0'))[0] / 100
+    return {
+        'ssid': raw_ssid.decode('utf8', 'replace'),
+        'bssid': ':'.join('%02x' % b for b in
+                          bss.get(nl80211h.NL80211_BSS_BSSID, b'')),
+        'freq': struct.unpack('=I', bss.get(nl80211h.NL80211_BSS_FREQUENCY,
+                                            b'\0\0\0\0'))[0],
+        'quality': dbm_to_quality(signal) if signal else 0.0,
+        'encrypted': bool(capability & WLAN_CAPABILITY_PRIVACY or
+                          IE_RSN in ies)
+    }
+
+
+class GenlSocket:
+    """Request/response generic netlink socket"""
+    def __init__(self):
+        self.lock = Lock()
+        self.seq = count(1)
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                  nlh.NETLINK_GENERIC)
+        self.sock.bind((0, 0))
+        self.sock.settimeout(5)
+
+    def request(self, family, cmd, attrs=b'', flags=0):
+        """Send a command and return the attribute dicts of the replies"""
+        flags = flags or nlh.NLM_F_ACK  # dumps end with NLMSG_DONE instead
+        with self.lock:
+            payload = GENLMSGHDR.pack(cmd, 1, 0) + attrs
+            header = NLMSGHDR.pack(NLMSGHDR.size + len(payload), family,
+                                   nlh.NLM_F_REQUEST | flags,
+                                   next(self.seq), 0)
+            self.sock.send(header + payload)
+            replies = []
+            while True:
+                for kind, data in parse_messages(self.sock.recv(65536)):
+                    if kind == nlh.NLMSG_DONE:
+                        return replies
+                    if kind == nlh.NLMSG_ERROR:
+                        error = struct.unpack_from('=i', data)[0]
+                        if error:
+                            raise OSError(-error, 'Generic netlink error')
+                        return replies
+                    replies.append(parse_attrs(data, GENLMSGHDR.size))
+
+    def resolve(self, name):
+        """Family id and multicast group ids of a generic netlink family"""
+        replies = self.request(genlh.GENL_ID_CTRL, genlh.CTRL_CMD_GETFAMILY,
+                               pack_attr(genlh.CTRL_ATTR_FAMILY_NAME,
+                                         name.encode() + b'\0'))
+        attrs = replies[0]
+        family = struct.unpack('=H', attrs[genlh.CTRL_ATTR_FAMILY_ID][:2])[0]
+        groups = {}
+        nested = parse_attrs(attrs.get(genlh.CTRL_ATTR_MCAST_GROUPS, b''))
+        for group in map(parse_attrs, nested.values()):
+            group_name = group[genlh.CTRL_ATTR_MCAST_GRP_NAME].rstrip(b'\0')
+            groups[group_name.decode()] = struct.unpack(
+                '=I', group[genlh.CTRL_ATTR_MCAST_GRP_ID])[0]
+        return family, groups
+
+    def close(self):
+        self.sock.close()
+
+
+class Nl80211Scanner:
+    """
+    Active scans through nl80211 without forking iwlist
+
+    Usage:
+        >>> scanner = Nl80211Scanner('wlan0')
+        >>> [bss['ssid'] for bss in scanner.scan()]
+        ['MyWifi', 'Neighbours']
+    """
+    def __init__(self, iface):
+        self.ifindex = socket.if_nametoindex(iface)
+        self.genl = GenlSocket()
+        try:
+            self.family, groups = self.genl.resolve(nl80211h.NL80211_GENL_NAME)
+            self.events = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                        nlh.NETLINK_GENERIC)
+            self.events.bind((0, 0))
+            self.events.setsockopt(SOL_NETLINK, nlh.NETLINK_ADD_MEMBERSHIP,
+                                   groups[nl80211h.NL80211_MULTICAST_GROUP_SCAN])
+        except (KeyError, IndexError) as e:
+            self.genl.close()
+            raise OSError(errno.ENOENT, 'nl80211 unavailable: %s' % e)
+        except OSError:
+            self.genl.close()
+            raise
+
+    def ifindex_attr(self):
+        return pack_attr(nl80211h.NL80211_ATTR_IFINDEX,
+                         struct.pack('=I', self.ifindex))
+
+    def drain(self):
+        """Discard notifications of scans that finished before ours"""
+        self.events.setblocking(False)
+        try:
+            while self.events.recv(65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def trigger(self):
+        wildcard = pack_attr(1, b'')  # one empty SSID makes the scan active
+        attrs = self.ifindex_attr() + pack_attr(
+            nl80211h.NL80211_ATTR_SCAN_SSIDS | NLA_F_NESTED, wildcard)
+        try:
+            self.genl.request(self.family, nl80211h.NL80211_CMD_TRIGGER_SCAN,
+                              attrs)
+        except OSError as e:
+            if e.errno != errno.EBUSY:
+                raise
+            LOG.debug('Scan already running, waiting for its results')
+
+    def wait(self, timeout):
+        """Wait for NEW_SCAN_RESULTS, False if aborted or timed out"""
+        deadline = monotonic() + timeout
+        while True:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return False
+            self.events.settimeout(remaining)
+            try:
+                data = self.events.recv(65536)
+            except socket.timeout:
+                return False
+            for _, payload in parse_messages(data):
+                cmd = payload[0]
+                ifindex = parse_attrs(payload, GENLMSGHDR.size).get(
+                    nl80211h.NL80211_ATTR_IFINDEX)
+                if ifindex != struct.pack('=I', self.ifindex):
+                    continue
+                if cmd == nl80211h.NL80211_CMD_NEW_SCAN_RESULTS:
+                    return True
+                if cmd == nl80211h.NL80211_CMD_SCAN_ABORTED:
+                    return False
+
+    def results(self):
+        """Current contents of the kernel BSS table"""
+        replies = self.genl.request(self.family, nl80211h.NL80211_CMD_GET_SCAN,
+                                    self.ifindex_attr(), nlh.NLM_F_DUMP)
+        return [bss for bss in map(parse_bss, replies) if bss]
+
+    def scan(self, timeout=10):
+        self.drain()
+        self.trigger()
+        if not self.wait(timeout):
+            LOG.warning('Scan did not complete, using the last known results')
+        return self.results()
+
+    def close(self):
+        self.genl.close()
+        self.events.close()
+
+
+class ScanCache:
+    """
+    Serve scan results from memory for ttl seconds. Callers arriving while
+    a scan runs wait for it instead of starting another one. Background
+    scans are skipped while any pause() is in effect
+    """
+    def __init__(self, scan, ttl):
+        self.scan = scan
+        self.ttl = ttl
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.paused = set()
+        self.results = None
+        self.updated = 0.0
+
+    def get(self, max_age=None):
+        max_age = self.ttl if max_age is None else max_age
+        with self.lock:
+            if self.results is None or monotonic() - self.updated > max_age:
+                self.results = self.scan()
+                self.updated = monotonic()
+            return self.results
+
+    def refresh(self):
+        """Scan now, or share a scan that finished while we were waiting"""
+        requested = monotonic()
+        with self.lock:
+            if self.results is None or self.updated < requested:
+                self.results = self.scan()
+                self.updated = monotonic()
+            return self.results
+
+    def snapshot(self):
+        """Last results without scanning, None before the first scan"""
+        return self.results
+
+    def start(self, interval):
+        """Keep the results fresh from a background thread"""
+        self.stop_event.clear()
+        Thread(target=self._refresh_loop, args=[interval], daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def pause(self, reason):
+        """Hold background scans until resume() is called with the reason"""
+        if reason not in self.paused:
+            LOG.debug('Pausing background scans: %s', reason)
+        self.paused.add(reason)
+
+    def resume(self, reason):
+        self.paused.discard(reason)
+
+    def _refresh_loop(self, interval):
+        while not self.stop_event.is_set():
+            if not self.paused:
+                try:
+                    self.refresh()
+                except:
+                    LOG.exception('Background scan failed')
+            self.stop_event.wait(interval)
@@ -0,0 +1,349 @@
+# Copyright 2017 Mycroft AI, Inc.
+#
+# This file is part of Mycroft Wifi Setup.
+#
+# Mycroft Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mycroft Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mycroft Core.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Hardware free stand-ins for the system parts behind WifiClient, so whole
+setup sessions can run on any Linux machine:
+  * FakeWpaSupplicant answers the control socket protocol and sends the
+    events of connection attempts and of phones joining the access point
+  * FakeScanSource returns a fixed set of networks after a scan delay
+  * SimulatedBackend ties them together and writes dnsmasq style leases
+"""
+import os
+import random
+import shutil
+import socket
+import tempfile
+import time
+from logging import getLogger
+from os.path import join
+from select import select
+from threading import Event, Lock, Thread, Timer
+
+from wifisetup.wpa_ctrl import BUFFER_SIZE, WpaEventListener
+
+LOG = getLogger(__name__)
+
+CORRECT_PASSWORD = 'password'  # every simulated secured network uses this
+
+
+def make_networks(count, seed=0):
+    """Cells in the format of Nl80211Scanner.scan()"""
+    rand = random.Random(seed)
+    cells = []
+    for i in range(count):
+        cells.append({
+            'ssid': 'Network %d' % i,
+            'bssid': '02:00:00:00:%02x:%02x' % (i // 256, i % 256),
+            'freq': rand.choice([2412, 2437, 2462, 5180, 5240]),
+            'quality': round(rand.uniform(0.1, 1.0), 2),
+            'encrypted': i % 4 != 0
+        })
+    return cells
+
+
+class FakeScanSource:
+    """ Scanner returning the same networks after a fixed delay """
+
+    def __init__(self, cells, delay=0.5):
+        self.cells = cells
+        self.delay = delay
+        self.scans = 0
+
+    def scan(self):
+        time.sleep(self.delay)
+        self.scans += 1
+        return self.results()
+
+    def results(self):
+        """Networks of the last scan, without scanning"""
+        return [dict(cell) for cell in self.cells] if self.scans else []
+
+    def close(self):
+        pass
+
+
+class FakeWpaSupplicant(Thread):
+    """
+    Serve wpa_supplicant control sockets for a station interface and,
+    once P2P_GROUP_ADD was received, for its p2p group interface
+
+    Usage:
+        >>> wpa = FakeWpaSupplicant('/tmp/ctrl', 'wlan0', make_networks(5))
+        >>> wpa.start()
+        >>> WpaCtrl('wlan0', '/tmp/ctrl').ping()
+        True
+    """
+    def __init__(self, ctrl_dir, iface, cells, connect_delay=0.3,
+                 dhcp_delay=0.2):
+        super(FakeWpaSupplicant, self).__init__(daemon=True)
+        self.ctrl_dir = ctrl_dir
+        self.iface = iface
+        self.group = 'p2p-%s-0' % iface
+        self.cells = {cell['ssid']: cell for cell in cells}
+        self.connect_delay = connect_delay
+        self.dhcp_delay = dhcp_delay
+        self.lock = Lock()
+        self.running = True
+        self.sockets = {}
+        self.attached = {}
+        self.networks = {}
+        self.next_id = 0
+        self.status = {'wpa_state': 'DISCONNECTED'}
+        self.group_removed = Event()
+        self.group_removed_at = None
+        self.add_socket(iface)
+
+    def add_socket(self, iface):
+        path = join(self.ctrl_dir, iface)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        with self.lock:
+            self.sockets[iface] = sock
+            self.attached[iface] = set()
+
+    def remove_socket(self, iface):
+        with self.lock:
+            sock = self.sockets.pop(iface, None)
+            self.attached.pop(iface, None)
+        if sock:
+            sock.close()
+            os.remove(join(self.ctrl_dir, iface))
+
+    def interfaces(self):
+        with self.lock:
+            return list(self.sockets)
+
+    def send_event(self, iface, event, level=3):
+        with self.lock:
+            sock = self.sockets.get(iface)
+            clients = list(self.attached.get(iface, []))
+        for client in clients:
+            try:
+                sock.sendto(('<%d>%s' % (level, event)).encode(), client)
+            except OSError:
+                with self.lock:
+                    self.attached.get(iface, set()).discard(client)
+
+    def run(self):
+        while self.running:
+            with self.lock:
+                socks = {sock: iface for iface, sock in self.sockets.items()}
+            try:
+                readable = select(list(socks), [], [], 0.1)[0]
+            except (OSError, ValueError):
+                continue  # a socket was closed while waiting
+            for sock in readable:
+                try:
+                    data, client = sock.recvfrom(BUFFER_SIZE)
+                except OSError:
+                    continue
+                reply = self.handle(socks[sock], client, data.decode())
+                try:
+                    sock.sendto(reply.encode(), client)
+                except OSError:
+                    pass
+
+    def handle(self, iface, client, command):
+        name, _, args = command.partition(' ')
+        args = args.split(' ', 2) if args else []
+        handler = getattr(self, 'do_' + name.lower(), None)
+        if not handler:
+            return 'UNKNOWN COMMAND\n'
+        return handler(iface, client, args)
+
+    def do_ping(self, *_):
+        return 'PONG\n'
+
+    def do_attach(self, iface, client, _):
+        with self.lock:
+            self.attached[iface].add(client)
+        return 'OK\n'
+
+    def do_detach(self, iface, client, _):
+        with self.lock:
+            self.attached[iface].discard(client)
+        return 'OK\n'
+
+    def do_status(self, iface, *_):
+        if iface == self.group:
+            status = {'wpa_state': 'COMPLETED', 'mode': 'P2P GO'}
+        else:
+            status = self.status
+        return ''.join('%s=%s\n' % item for item in status.items())
+
+    def do_p2p_group_add(self, *_):
+        if self.group not in self.interfaces():
+            self.add_socket(self.group)
+            self.group_removed.clear()
+        return 'OK\n'
+
+    def do_p2p_group_remove(self, iface, client, args):
+        self.remove_socket(args[0] if args else self.group)
+        self.group_removed_at = time.monotonic()
+        self.group_removed.set()
+        return 'OK\n'
+
+    def do_p2p_get_passphrase(self, *_):
+        return '12345678'
+
+    def do_add_network(self, *_):
+        with self.lock:
+            nid = self.next_id
+            self.next_id += 1
+            self.networks[nid] = {'disabled': True}
+        return '%d\n' % nid
+
+    def do_set_network(self, iface, client, args):
+        if len(args) < 3 or int(args[0]) not in self.networks:
+            return 'FAIL\n'
+        self.networks[int(args[0])][args[1]] = args[2].strip('"')
+        return 'OK\n'
+
+    def do_remove_network(self, iface, client, args):
+        return 'OK\n' if self.networks.pop(int(args[0]), None) else 'FAIL\n'
+
+    def do_list_networks(self, *_):
+        lines = ['network id / ssid / bssid / flags']
+        for nid, network in sorted(self.networks.items()):
+            lines.append('%d\t%s\tany\t%s' % (
+                nid, network.get('ssid', ''),
+                '[DISABLED]' if network['disabled'] else ''))
+        return '\n'.join(lines) + '\n'
+
+    def do_save_config(self, *_):
+        return 'OK\n'
+
+    def do_disable_network(self, iface, client, args):
+        nid = int(args[0])
+        if nid not in self.networks:
+            return 'FAIL\n'
+        self.networks[nid]['disabled'] = True
+        if self.status.get('id') == str(nid):
+            self.status = {'wpa_state': 'DISCONNECTED'}
+        return 'OK\n'
+
+    def do_enable_network(self, iface, client, args):
+        nid = int(args[0])
+        if nid not in self.networks:
+            return 'FAIL\n'
+        self.networks[nid]['disabled'] = False
+        self.send_event(self.iface, 'CTRL-EVENT-SCAN-STARTED ')
+        Timer(self.connect_delay, self.associate, [nid]).start()
+        return 'OK\n'
+
+    do_select_network = do_enable_network
+
+    def associate(self, nid):
+        """Play the events of a connection attempt to network nid"""
+        network = self.networks.get(nid, {})
+        cell = self.cells.get(network.get('ssid'))
+        if not cell:
+            self.send_event(self.iface, 'CTRL-EVENT-NETWORK-NOT-FOUND')
+            return
+        bssid = cell['bssid']
+        self.send_event(self.iface, 'SME: Trying to authenticate with ' +
+                        bssid)
+        self.send_event(self.iface, 'Associated with ' + bssid)
+        if cell['encrypted'] and network.get('psk') != CORRECT_PASSWORD:
+            self.send_event(self.iface, 'CTRL-EVENT-SSID-TEMP-DISABLED '
+                            'id=%d ssid="%s" auth_failures=1 duration=10 '
+                            'reason=WRONG_KEY' % (nid, cell['ssid']))
+            return
+        self.send_event(self.iface, 'WPA: Key negotiation completed with ' +
+                        bssid)
+        self.status = {
+            'bssid': bssid,
+            'freq': str(cell['freq']),
+            'ssid': cell['ssid'],
+            'id': str(nid),
+            'mode': 'station',
+            'key_mgmt': 'WPA2-PSK' if cell['encrypted'] else 'NONE',
+            'wpa_state': 'COMPLETED'
+        }
+        self.send_event(self.iface, 'CTRL-EVENT-CONNECTED - Connection to ' +
+                        bssid + ' completed [id=%d id_str=]' % nid)
+        Timer(self.dhcp_delay, self.status.update,
+              [{'ip_address': '192.168.1.%d' % (100 + nid)}]).start()
+
+    def close(self):
+        self.running = False
+        if self.is_alive():
+            self.join(1)
+        for iface in self.interfaces():
+            self.remove_socket(iface)
+
+
+class SimulatedBackend:
+    """
+    Backend for WifiClient without any wifi hardware, root or daemons.
+    All state lives in a temporary directory removed by close()
+
+    Usage:
+        >>> backend = SimulatedBackend(networks=30)
+        >>> client = WifiClient(backend=backend)
+        >>> backend.join_station('02:00:00:00:01:00', '172.24.1.60', 'phone')
+    """
+    bus_url = None
+    http_host = '127.0.0.1'
+    http_port = 0  # any free port, see WebServer.server.server_address
+
+    def __init__(self, networks=20, scan_delay=0.5, connect_delay=0.3,
+                 dhcp_delay=0.2, iface='wlan0'):
+        self.dir = tempfile.mkdtemp(prefix='wifisetup-sim-')
+        self.ctrl_dir = join(self.dir, 'wpa_supplicant')
+        self.run_dir = join(self.dir, 'run')
+        self.known_networks_file = join(self.dir, 'known_networks.json')
+        os.makedirs(self.ctrl_dir)
+        self.cells = make_networks(networks)
+        self.scan_delay = scan_delay
+        self.lease_file = None
+        self.wpa = FakeWpaSupplicant(self.ctrl_dir, iface, self.cells,
+                                     connect_delay, dhcp_delay)
+        self.wpa.start()
+
+    def interfaces(self):
+        return self.wpa.interfaces()
+
+    def set_address(self, iface, ip):
+        pass
+
+    def create_scanner(self, iface):
+        return FakeScanSource(self.cells, self.scan_delay)
+
+    def create_event_listener(self, iface):
+        return WpaEventListener(iface, self.ctrl_dir)
+
+    def start_dhcp(self, ap):
+        self.lease_file = ap.lease_file
+        open(self.lease_file, 'w').close()
+
+    def stop_dhcp(self, ap):
+        pass
+
+    def join_station(self, mac, ip, hostname='*'):
+        """A phone joins the access point and gets a lease"""
+        self.wpa.send_event(self.wpa.group, 'AP-STA-CONNECTED ' + mac)
+        with open(self.lease_file, 'a') as f:
+            f.write('%d %s %s %s *\n' % (time.time() + 43200, mac, ip,
+                                         hostname))
+
+    def leave_station(self, mac):
+        self.wpa.send_event(self.wpa.group, 'AP-STA-DISCONNECTED ' + mac)
+
+    def close(self):
+        self.wpa.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
@@ -0,0 +1,181 @@
+# Copyright 2017 Mycroft AI, Inc.
+#
+# This file is part of Mycroft Wifi Setup.
+#
+# Mycroft Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mycroft Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mycroft Core.  If not, see <http://www.gnu.org/licenses/>.
+import json
+from collections import deque
+from logging import getLogger
+from threading import Condition, Event, Thread
+from time import monotonic
+
+from websocket import WebSocketApp
+
+LOG = getLogger(__name__)
+
+# Only the newest message of these types matters when several are queued
+LATEST_ONLY = {'connection.status'}
+
+
+def is_full_scan(message):
+    return message['type'] == 'wifi.scanned' and \
+        'networks' in message.get('data', {})
+
+
+def coalesce(messages):
+    """
+    Drop messages that a later one in the same batch makes obsolete: older
+    LATEST_ONLY messages and any scan result before a full scan list
+    """
+    last_full_scan = max((i for i, m in enumerate(messages)
+                          if is_full_scan(m)), default=-1)
+    result = []
+    for i, message in enumerate(messages):
+        kind = message['type']
+        if kind == 'wifi.scanned' and i < last_full_scan:
+            continue
+        if kind in LATEST_ONLY and any(m['type'] == kind
+                                       for m in messages[i + 1:]):
+            continue
+        result.append(message)
+    return result
+
+
+class BusTransport:
+    """
+    Websocket connection to the messagebus that queues outgoing messages
+    while disconnected, reconnects with exponential backoff and sends
+    bursts as a single 'wifi.batch' frame
+
+    Usage:
+        >>> transport = BusTransport(config.websocket['url'], on_message)
+        >>> transport.start()
+        >>> transport.send('wifi.scanned', {'networks': {}})
+    """
+    def __init__(self, url, on_message, max_queue=256, batch_window=0.02,
+                 min_backoff=0.5, max_backoff=10):
+        self.url = url
+        self.on_message = on_message
+        self.batch_window = batch_window
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.queue = deque(maxlen=max_queue)
+        self.cond = Condition()
+        self.connected = Event()
+        self.stopped = Event()
+        self.running = False
+        self.app = None
+        self.dropped = 0
+        self.sent_frames = 0
+        self.sent_messages = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        self.running = True
+        Thread(target=self._connect_loop, daemon=True).start()
+        Thread(target=self._send_loop, daemon=True).start()
+
+    def send(self, name, data=None):
+        """Queue a message, dropping the oldest one when the queue is full"""
+        with self.cond:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append((monotonic(), {'type': name, 'data': data or {}}))
+            self.cond.notify()
+
+    def stats(self):
+        return {
+            'queue_depth': len(self.queue),
+            'dropped': self.dropped,
+            'frames': self.sent_frames,
+            'messages': self.sent_messages,
+            'latency_avg': self.latency_total / max(self.sent_messages, 1),
+            'latency_max': self.latency_max
+        }
+
+    def _on_open(self, *_):
+        LOG.info('Connected to ' + self.url)
+        self.connected.set()
+        with self.cond:
+            self.cond.notify()
+
+    def _on_message(self, _, message):
+        self.on_message(self, message)
+
+    def _connect_loop(self):
+        backoff = self.min_backoff
+        while self.running:
+            self.app = WebSocketApp(url=self.url, on_open=self._on_open,
+                                    on_message=self._on_message)
+            started = monotonic()
+            try:
+                self.app.run_forever()
+            except Exception:
+                LOG.exception('Websocket error')
+            self.connected.clear()
+            if not self.running:
+                break
+            if monotonic() - started > self.max_backoff:
+                backoff = self.min_backoff  # it was up for a while
+            LOG.warning('Websocket closed, reconnecting in %ss', backoff)
+            self.stopped.wait(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def _take_batch(self):
+        """Wait for messages and a connection, then take the whole burst"""
+        with self.cond:
+            while self.running and not (self.queue and self.connected.is_set()):
+                self.cond.wait(1)
+            if not self.running:
+                return []
+            end = monotonic() + self.batch_window  # let a burst accumulate
+            while monotonic() < end:
+                self.cond.wait(end - monotonic())
+            batch = list(self.queue)
+            self.queue.clear()
+            return batch
+
+    def _send_loop(self):
+        while self.running:
+            batch = self._take_batch()
+            if not batch:
+                continue
+            messages = coalesce([message for _, message in batch])
+            if len(messages) == 1:
+                frame = messages[0]
+            else:
+                frame = {'type': 'wifi.batch', 'data': {'messages': messages}}
+            try:
+                self.app.send(json.dumps(frame))
+            except Exception:
+                LOG.warning('Send failed, requeueing %d messages', len(batch))
+                with self.cond:
+                    self.queue.extendleft(reversed(batch))
+                self.connected.clear()
+                continue
+            now = monotonic()
+            self.sent_frames += 1
+            self.sent_messages += len(batch)
+            for queued, _ in batch:
+                self.latency_total += now - queued
+                self.latency_max = max(self.latency_max, now - queued)
+
+    def close(self):
+        self.running = False
+        self.stopped.set()
+        with self.cond:
+            self.cond.notify_all()
+        if self.app:
+            self.app.close()
@@ -14,47 +14,320 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with Mycroft Core.  If not, see <http://www.gnu.org/licenses/>.
+import json
+import os
 import sys
+import time
+from collections import Counter, deque
 from logging import getLogger
+from os.path import basename
 from subprocess import Popen, PIPE
+from threading import Lock
+
+from wifisetup.wpa_ctrl import CTRL_DIR, WpaCtrl, format_command, \
+    parse_network_id, parse_passphrase, parse_status
 
 LOG = getLogger(__name__)
 
+wpa_ctrls = {}
+ctrl_dir = CTRL_DIR
+
+# Files to record system interaction to, or to replay it from
+COMMAND_RECORD_ENV = 'WIFISETUP_RECORD'
+COMMAND_REPLAY_ENV = 'WIFISETUP_REPLAY'
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)  # ms
+SECRET_FIELDS = ('psk', 'password', 'sae_password')  # of set_network
+REDACTED = '"<redacted>"'
+
+# The admin service passes a pipe for structured events in this variable
+EVENT_FD_ENV = 'WIFISETUP_EVENT_FD'
+EVENT_VERSION = 1
+event_lock = Lock()
+event_stream = None
+
+
+def get_event_stream():
+    """Line buffered writer for the structured event pipe, None if absent"""
+    global event_stream
+    if event_stream is None and os.environ.get(EVENT_FD_ENV):
+        try:
+            event_stream = os.fdopen(int(os.environ[EVENT_FD_ENV]), 'w',
+                                     buffering=1)
+        except (OSError, ValueError):
+            LOG.warning('Invalid %s, using stdout events', EVENT_FD_ENV)
+            del os.environ[EVENT_FD_ENV]
+    return event_stream
+
 
-def trigger_event(name):
-    """Send a message to the caller"""
+def trigger_event(name, data=None, component='wifisetup'):
+    """
+    Send a message to the caller. With an event pipe this is one JSON line:
+    {"v": 1, "event": name, "ts": <CLOCK_MONOTONIC>, "component", "data"}
+    otherwise the bare event name is printed to stdout
+    """
     LOG.info('Event: ' + name)
-    print(name, file=sys.stdout, flush=True)
+    with event_lock:
+        stream = get_event_stream()
+        if stream:
+            stream.write(json.dumps({
+                'v': EVENT_VERSION,
+                'event': name,
+                'ts': time.monotonic(),
+                'component': component,
+                'data': data or {}
+            }) + '\n')
+        else:
+            print(name, file=sys.stdout, flush=True)
+
+
+def command_name(args):
+    """'wpa_cli -i wlan0 status' -> 'wpa_cli status', to group stats by"""
+    words = [basename(args[0])] + [a for a in args[1:] if a[:1] != '-']
+    if words[0] in ('wpa_cli', 'wpa_ctrl') and len(words) > 2:
+        return words[0] + ' ' + words[2].split(' ')[0].lower()
+    return ' '.join(words[:2])
+
+
+def redact(args):
+    """
+    Arguments as strings with set_network secrets masked, both as wpa_cli
+    arguments and in 'SET_NETWORK 0 psk "..."' control socket commands
+    """
+    args = [str(arg) for arg in args]
+    for i, arg in enumerate(args):
+        words = arg.split(' ', 3)
+        if len(words) == 4 and words[0].lower() == 'set_network' and \
+                words[2].lower() in SECRET_FIELDS:
+            args[i] = ' '.join(words[:3] + [REDACTED])
+        elif i >= 3 and args[i - 3].lower() == 'set_network' and \
+                args[i - 1].lower() in SECRET_FIELDS:
+            args[i] = REDACTED
+    return args
+
+
+class CommandExecutor:
+    """
+    Time every interaction with the system, per command. With a record
+    file each call and its result are appended to it as a JSON line, with
+    a replay file the recorded results are served back with their original
+    timings instead of touching the system. Secrets are redacted from the
+    recorded arguments and the replayed calls are matched the same way
+
+    Usage:
+        >>> executor = CommandExecutor(replay='/tmp/session.jsonl')
+        >>> executor.run(['systemctl', 'stop', 'dnsmasq'], fork, missing)
+    """
+    def __init__(self, record=None, replay=None):
+        self.lock = Lock()
+        self.forks = 0
+        self.commands = {}
+        self.record_file = open(record, 'a', buffering=1) if record else None
+        self.replay = self.load(replay) if replay else None
+
+    @staticmethod
+    def load(path):
+        recorded = {}
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                key = tuple(redact(entry['args']))
+                recorded.setdefault(key, deque()).append(entry)
+        LOG.info('Replaying %d commands from %s', len(recorded), path)
+        return recorded
+
+    @property
+    def replaying(self):
+        return self.replay is not None
+
+    @property
+    def recording(self):
+        return self.record_file is not None
+
+    def run(self, args, func, missing=None, forks=0):
+        """
+        Result of func(), or of the recorded call with the same arguments
+        when replaying. missing is returned if the call was not recorded.
+        forks is the number of processes func starts without fork()
+        """
+        args = redact(args)
+        start = time.monotonic()
+        if self.replaying:
+            entry = self.replayed(args)
+            if entry is None:
+                LOG.warning('No recording of %s', args)
+                return missing
+            time.sleep(entry['duration'])
+            result = entry['result']
+        else:
+            result = func()
+            with self.lock:
+                self.forks += forks
+        duration = time.monotonic() - start
+        self.count(args, duration, result)
+        self.record(args, result, duration)
+        return result
+
+    def record(self, args, result, duration):
+        """Append a call to the record file, if there is one"""
+        if self.record_file:
+            with self.lock:
+                self.record_file.write(json.dumps({
+                    'args': redact(args), 'result': result,
+                    'duration': round(duration, 6)
+                }) + '\n')
+
+    def replayed(self, args):
+        """Next recording of a call, the last one repeats once exhausted"""
+        with self.lock:
+            entries = self.replay.get(tuple(redact(args)))
+            if not entries:
+                return None
+            return entries.popleft() if len(entries) > 1 else entries[0]
+
+    def fork(self, args):
+        with self.lock:
+            self.forks += 1
+        proc = Popen(args=args, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = proc.communicate()
+        return {'code': proc.returncode, 'stdout': stdout.decode(), 'stderr': stderr.decode()}
+
+    def spawn(self, args):
+        """Start a long running process, counting the fork but not its run"""
+        start = time.monotonic()
+        with self.lock:
+            self.forks += 1
+        proc = Popen(args)
+        self.count(args, time.monotonic() - start, None)
+        return proc
+
+    def count(self, args, duration, result):
+        ms = duration * 1000
+        bucket = next((i for i, limit in enumerate(LATENCY_BUCKETS)
+                       if ms <= limit), len(LATENCY_BUCKETS))
+        with self.lock:
+            stats = self.commands.setdefault(command_name(args), {
+                'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                'histogram': [0] * (len(LATENCY_BUCKETS) + 1),
+                'exit_codes': Counter()
+            })
+            stats['count'] += 1
+            stats['total_ms'] += ms
+            stats['max_ms'] = max(stats['max_ms'], ms)
+            stats['histogram'][bucket] += 1
+            if isinstance(result, dict):
+                stats['exit_codes'][result.get('code')] += 1
+
+    def stats(self):
+        labels = ['<=%dms' % limit for limit in LATENCY_BUCKETS]
+        labels.append('>%dms' % LATENCY_BUCKETS[-1])
+        with self.lock:
+            return {
+                'forks': self.forks,
+                'commands': {name: {
+                    'count': stats['count'],
+                    'avg_ms': round(stats['total_ms'] / stats['count'], 3),
+                    'max_ms': round(stats['max_ms'], 3),
+                    'histogram': {label: n for label, n in
+                                  zip(labels, stats['histogram']) if n},
+                    'exit_codes': dict(stats['exit_codes'])
+                } for name, stats in self.commands.items()}
+            }
+
+
+executor = CommandExecutor(os.environ.get(COMMAND_RECORD_ENV),
+                           os.environ.get(COMMAND_REPLAY_ENV))
+
+
+def run_command(args):
+    return executor.run(args, lambda: executor.fork(args), {
+        'code': 127, 'stdout': '', 'stderr': 'Not recorded'
+    })
 
 
 def cli_no_output(*args):
     """ Invoke a command line and return result """
-    LOG.info("Command: %s" % list(args))
-    proc = Popen(args=args, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = proc.communicate()
-    return {'code': proc.returncode, 'stdout': stdout.decode(), 'stderr': stderr.decode()}
+    LOG.info("Command: %s", redact(args))
+    return run_command(args)
 
 
 def cli(*args):
     """ Invoke a command line, then log and return result """
-    LOG.info("Command: %s" % list(args))
-    proc = Popen(args=args, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = proc.communicate()
-    result = {'code': proc.returncode, 'stdout': stdout.decode(), 'stderr': stderr.decode()}
-    LOG.info("Command result: %s" % result)
+    LOG.info("Command: %s", redact(args))
+    result = run_command(args)
+    LOG.debug("Command result: %s", result)
     return result
 
 
-def wpa(*args):
-    idx = 0
+def get_wpa_ctrl(iface):
+    """Shared control socket connection for iface, or None if unavailable"""
+    ctrl = wpa_ctrls.get(iface)
+    if not ctrl:
+        try:
+            ctrl = wpa_ctrls[iface] = WpaCtrl(iface, ctrl_dir)
+        except OSError as e:
+            LOG.debug('No control socket for %s: %s', iface, e)
+    return ctrl
+
+
+def close_wpa_ctrl(iface):
+    ctrl = wpa_ctrls.pop(iface, None)
+    if ctrl:
+        ctrl.close()
+
+
+def use_ctrl_dir(path):
+    """Send wpa commands to the control sockets in another directory"""
+    global ctrl_dir
+    if path != ctrl_dir:
+        for iface in list(wpa_ctrls):
+            close_wpa_ctrl(iface)
+        ctrl_dir = path
+
+
+def wpa_cli(*args):
+    """Fallback that forks wpa_cli, returns the reply without the banner"""
     result = cli('wpa_cli', '-i', *args)
     out = result["stdout"]
-    if 'interface' in out:
-        idx = 1
     if result['code'] != 0:
         LOG.error('WPA command failed: ' + result['stdout'] + result['stderr'])
-    return str(out.split("\n")[idx])
+    if out.startswith('Selected interface'):
+        out = out.split("\n", 1)[-1]
+    return out
+
+
+def wpa_batch(iface, *commands):
+    """Run several wpa commands, pipelined over the control socket if possible"""
+    ctrl = None if executor.replaying else get_wpa_ctrl(iface)
+    if ctrl or executor.replaying:
+        try:
+            key = redact(['wpa_ctrl', iface] +
+                         [format_command(*c) for c in commands])
+            LOG.info("WPA %s: %s", iface, key[2:])
+            replies = executor.run(key, lambda: ctrl.pipeline(*commands))
+            for reply in replies or []:
+                if reply.startswith('FAIL'):
+                    LOG.error('WPA command failed: ' + reply)
+            if replies is not None:
+                return replies
+        except OSError:
+            LOG.warning('Control socket for %s failed, using wpa_cli', iface)
+            close_wpa_ctrl(iface)
+    return [wpa_cli(iface, *args) for args in commands]
+
+
+def wpa(*args):
+    return str(wpa_batch(args[0], args[1:])[0].split("\n")[0])
+
+
+def wpa_status(iface):
+    return parse_status(wpa_batch(iface, ['status'])[0])
+
+
+def wpa_add_network(iface):
+    """Id of a new network block, raises RuntimeError if none was added"""
+    return parse_network_id(wpa_batch(iface, ['add_network'])[0])
 
 
-def sysctrl(*args):
-    return cli('systemctl', *args)
+def wpa_passphrase(iface):
+    """Passphrase of a p2p group, raises RuntimeError if there is none"""
+    return parse_passphrase(wpa_batch(iface, ['p2p_get_passphrase'])[0], iface)
@@ -1,5 +1,5 @@
 var Config = {
-    wsUrl: "ws://172.24.1.1:8181/core",
+    wsUrl: "ws://" + window.location.host + "/wifi",
     cancelUrl: "https://mycroft.ai/",
     registerUrl: "https://home.mycroft.ai/#/device/add"
 };
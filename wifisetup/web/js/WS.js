@@ -2,11 +2,17 @@ var WS = {
     ws: null,
     listeners: {},
     onOpenListeners: [],
+    opened: false,
+    closed: false,
+    pending: [],
+    retryDelay: 500,
+    maxRetryDelay: 10000,
 
     connect: function () {
         this.ws = new WebSocket(Config.wsUrl);
         this.ws.onmessage = this.onMessage.bind(this);
         this.ws.onopen = this.onOpen.bind(this);
+        this.ws.onclose = this.onClose.bind(this);
     },
 
     setOnOpenListener: function (cb) {
@@ -14,7 +20,14 @@ var WS = {
     },
 
     onMessage: function (evt) {
-        var msg = JSON.parse(evt.data);
+        this.dispatch(JSON.parse(evt.data));
+    },
+
+    dispatch: function (msg) {
+        if (msg.type === "wifi.batch") {
+            msg.data.messages.forEach(this.dispatch.bind(this));
+            return;
+        }
         if (this.listeners[msg.type]) {
             this.listeners[msg.type].forEach(function (cb) {
                 cb(msg.data);
@@ -23,17 +36,40 @@ var WS = {
     },
 
     onOpen: function () {
-        this.onOpenListener();
+        this.retryDelay = 500;
+        // A reconnect resumes the page as it is, only the first open sets it up
+        if (!this.opened) {
+            this.opened = true;
+            this.onOpenListener();
+        }
+        this.pending.splice(0).forEach(this.ws.send.bind(this.ws));
+    },
+
+    onClose: function () {
+        if (this.closed) {
+            return;
+        }
+        setTimeout(this.connect.bind(this), this.retryDelay);
+        this.retryDelay = Math.min(this.retryDelay * 2, this.maxRetryDelay);
     },
 
     send: function (type, data) {
-        this.ws.send(JSON.stringify({
+        if (this.closed) {
+            return;
+        }
+        var message = JSON.stringify({
             type: type,
             data: data
-        }));
+        });
+        if (this.ws.readyState === WebSocket.OPEN) {
+            this.ws.send(message);
+        } else {
+            this.pending.push(message);  // sent once reconnected
+        }
     },
 
     close: function () {
+        this.closed = true;
         this.ws.close();
         this.ws = null;
     },
@@ -24,6 +24,8 @@ function showPanel(id) {
 var WifiSetup = {
 
         selectedNetword: null,
+        networks: {},
+        scanSeq: 0,
 
         setListeners: function () {
             WS.addMessageListener("connection.status", this.onConnectionStatus.bind(this));
@@ -52,39 +54,95 @@ var WifiSetup = {
                     showPanel("success");
                     startPing();
                 }, 2000);
-            } else {
+            } else if (this.selectedNetword) {
                 showPanel("list-panel");
                 this.renderErrorItem(this.selectedNetword.el);
             }
         },
 
         onScanned: function (data) {
-            var networks = data.networks,
-                fragment = document.createDocumentFragment(),
-                list = document.querySelector("#list"),
-                item = null,
-                li = null;
+            if (data.networks) {
+                this.renderList(data.networks);
+            } else if (data.seq !== this.scanSeq + 1) {
+                // Missed a delta, ask for the whole list again
+                WS.send("wifi.scan");
+                return;
+            } else {
+                this.patchList(data);
+            }
+            this.scanSeq = data.seq;
+        },
+
+        renderList: function (networks) {
+            var fragment = document.createDocumentFragment(),
+                list = document.querySelector("#list");
 
             showPanel("list-panel");
+            this.networks = {};
 
             Object.keys(networks).sort(function (a, b) {
-                if (networks[a].quality < networks[b].quality) {
-                    return 1;
-                }
-                return 0;
-            }).forEach(function (network) {
-                li = document.createElement("li");
-                networks[network].ssid = network;
-                networks[network].el = li;
-                item = this.renderListItem(networks[network]);
-                li.appendChild(item);
-                fragment.appendChild(li);
+                return networks[b].quality - networks[a].quality;
+            }).forEach(function (ssid) {
+                fragment.appendChild(this.createListEntry(ssid, networks[ssid]));
             }.bind(this));
 
             list.innerHTML = null;
             list.appendChild(fragment);
         },
 
+        patchList: function (data) {
+            var list = document.querySelector("#list");
+
+            data.removed.forEach(function (ssid) {
+                var network = this.networks[ssid];
+                if (network && network !== this.selectedNetword) {
+                    list.removeChild(network.el);
+                    delete this.networks[ssid];
+                }
+            }.bind(this));
+
+            Object.keys(data.changed).forEach(function (ssid) {
+                var network = this.networks[ssid],
+                    update = data.changed[ssid];
+                if (!network) {
+                    data.added[ssid] = update;
+                    return;
+                }
+                network.quality = update.quality;
+                network.el.querySelector("img.wifi").src = getImagePath(update.quality);
+                if (network.connected !== update.connected && network !== this.selectedNetword) {
+                    network.connected = update.connected;
+                    network.el.replaceChild(this.renderListItem(network),
+                                            network.el.querySelector(".list-item"));
+                }
+            }.bind(this));
+
+            Object.keys(data.added).forEach(function (ssid) {
+                var existing = this.networks[ssid];
+                if (existing) {
+                    // The selected network was kept when the server removed it
+                    existing.quality = data.added[ssid].quality;
+                    existing.el.querySelector("img.wifi").src = getImagePath(existing.quality);
+                    return;
+                }
+                var li = this.createListEntry(ssid, data.added[ssid]),
+                    next = Array.prototype.find.call(list.children, function (el) {
+                        return el.network.quality < li.network.quality;
+                    });
+                list.insertBefore(li, next || null);
+            }.bind(this));
+        },
+
+        createListEntry: function (ssid, network) {
+            var li = document.createElement("li");
+            network.ssid = ssid;
+            network.el = li;
+            li.network = network;
+            li.appendChild(this.renderListItem(network));
+            this.networks[ssid] = network;
+            return li;
+        },
+
         renderListItem: function (network) {
             var listItem = document.createElement("div"),
                 span = document.createElement("span"),
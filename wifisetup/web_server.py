@@ -14,57 +14,204 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with Mycroft Core.  If not, see <http://www.gnu.org/licenses/>.
+import gzip
+import hashlib
+import mimetypes
 import os
 import sys
 import encodings.idna  # Needed to make pyinstaller install the encoding
 
-from http.server import SimpleHTTPRequestHandler
+from http.server import BaseHTTPRequestHandler
 from logging import getLogger
-from os.path import abspath, dirname
-from socketserver import TCPServer
-from threading import Thread
+from os.path import abspath, dirname, getsize, join, relpath
+from urllib.parse import unquote, urlsplit
+from collections import Counter
+from socketserver import ThreadingMixIn, TCPServer
+from threading import BoundedSemaphore, Lock, Thread
 from time import sleep
 
 from wifisetup import config
+from wifisetup.portal_socket import PortalHub, PortalSocket, accept_key
 
 LOG = getLogger(__name__)
 
 
-class CaptiveHTTPRequestHandler(SimpleHTTPRequestHandler):
+# Connectivity check paths of each OS. Any answer other than the expected
+# one marks the network as captive, a redirect opens the portal straight away
+PROBES = {
+    '/generate_204': 'android',
+    '/gen_204': 'android',
+    '/hotspot-detect.html': 'apple',
+    '/library/test/success.html': 'apple',
+    '/connecttest.txt': 'windows',
+    '/ncsi.txt': 'windows',
+    '/redirect': 'windows',
+    '/success.txt': 'firefox',
+    '/canonical.html': 'firefox',
+    '/kindle-wifi/wifistub.html': 'kindle'
+}
+
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'image/x-icon',
+                      'image/vnd.microsoft.icon')
+
+
+class Asset:
+    """
+    A static file held in memory with its gzip variant and validators.
+    Raw assets, read per request, skip both to stay cheap
+    """
+    def __init__(self, path, data, raw=False):
+        self.type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.data = data
+        self.etag = None if raw else '"%s"' % hashlib.sha1(data).hexdigest()
+        self.gzip = None
+        if not raw and self.type.startswith(COMPRESSIBLE_TYPES):
+            compressed = gzip.compress(data, 9)
+            if len(compressed) < len(data):
+                self.gzip = compressed
+        if self.type == 'text/html':
+            self.cache_control = 'no-cache'  # always revalidate the page
+        else:
+            self.cache_control = 'max-age=%d' % config.asset_max_age
+
+
+class AssetCache:
+    """ Static files of the web directory, loaded once up to a size limit """
+
+    def __init__(self, root, limit=config.asset_cache_limit):
+        self.root = root
+        self.assets = {}
+        size = 0
+        for folder, _, files in os.walk(root):
+            for name in files:
+                path = join(folder, name)
+                file_size = getsize(path)
+                if size + file_size > limit:
+                    LOG.warning('Asset cache full, not caching ' + path)
+                    continue
+                size += file_size
+                self.assets['/' + relpath(path, root)] = self.load(path)
+        LOG.info('Cached %d web assets', len(self.assets))
+
+    @staticmethod
+    def load(path, raw=False):
+        with open(path, 'rb') as f:
+            return Asset(path, f.read(), raw)
+
+    def get(self, url_path):
+        """ Asset for a request path, read from disk if it was not cached """
+        path = unquote(urlsplit(url_path).path)
+        if path.endswith('/'):
+            path += 'index.html'
+        asset = self.assets.get(path)
+        if asset is None:
+            full_path = abspath(join(self.root, path.lstrip('/')))
+            if full_path.startswith(self.root + os.sep) and \
+                    os.path.isfile(full_path):
+                asset = self.load(full_path, raw=True)
+        return asset
+
+
+class CaptiveHTTPRequestHandler(BaseHTTPRequestHandler):
     """ Serve a single website, 303 redirecting all other requests to it """
+    protocol_version = 'HTTP/1.1'
+    timeout = config.http_timeout
 
     def do_HEAD(self):
-        LOG.info("do_HEAD being called....")
+        if self.answer_probe():
+            return
         if not self.redirect():
-            SimpleHTTPRequestHandler.do_HEAD(self)
+            self.send_asset(head=True)
 
     def do_GET(self):
-        LOG.info("do_GET being called....")
+        if self.upgrade_websocket() or self.answer_probe():
+            return
         if not self.redirect():
-            SimpleHTTPRequestHandler.do_GET(self)
+            self.send_asset()
+
+    def upgrade_websocket(self):
+        """ Hand the portal's websocket connection to the server's hub """
+        if urlsplit(self.path).path != config.portal_websocket_route or \
+                self.headers.get('Upgrade', '').lower() != 'websocket':
+            return False
+        key = self.headers.get('Sec-WebSocket-Key')
+        if not key:
+            self.send_error(400)
+            return True
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept_key(key))
+        self.end_headers()
+        self.close_connection = True
+        self.server.portal.serve(PortalSocket(self.connection, self.rfile,
+                                              self.wfile))
+        return True
+
+    def answer_probe(self):
+        """ Quietly redirect OS connectivity checks to the portal """
+        probe = PROBES.get(urlsplit(self.path).path)
+        if not probe or config.no_redirect_url in self.headers.get('host', ''):
+            return False
+        self.server.count_probe(probe)
+        self.send_response(302)
+        self.send_header("Location", config.server_url)
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return True
+
+    def log_request(self, code='-', size='-'):
+        if urlsplit(self.path).path not in PROBES:
+            BaseHTTPRequestHandler.log_request(self, code, size)
+
+    def log_message(self, format, *args):
+        """ Through the logging queue instead of writing to stderr here """
+        LOG.info('%s - ' + format, self.address_string(), *args)
+
+    def send_asset(self, head=False):
+        asset = self.server.assets.get(self.path)
+        if asset is None:
+            self.send_error(404)
+            return
+        body, etag = asset.data, asset.etag
+        if asset.gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body, etag = asset.gzip, asset.etag[:-1] + '-gz"'
+
+        if etag and etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            body = b''
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', asset.type)
+            if body is asset.gzip:
+                self.send_header('Content-Encoding', 'gzip')
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Cache-Control', asset.cache_control)
+        if asset.gzip:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
 
     def redirect(self):
         try:
-            LOG.info("***********************")
-            LOG.info("**   HTTP Request   ***")
-            LOG.info("***********************")
-            LOG.info("Requesting: " + self.path)
-            LOG.info("REMOTE_ADDR:" + self.client_address[0])
-            LOG.info("SERVER_NAME:" + self.server.server_address[0])
-            LOG.info("SERVER_PORT:" + str(self.server.server_address[1]))
-            LOG.info("SERVER_PROTOCOL:" + self.request_version)
-            LOG.info("HEADERS...")
-            LOG.info(self.headers)
-            LOG.info("***********************")
+            LOG.debug("HTTP Request %s %s from %s to %s:%s, headers: %s",
+                      self.request_version, self.path,
+                      self.client_address[0], *self.server.server_address,
+                      self.headers)
 
             # path = self.translate_path(self.path)
             if config.no_redirect_url in self.headers['host']:
-                LOG.info("No redirect")
+                LOG.debug("No redirect")
                 return False
             else:
-                LOG.info("303 redirect to " + config.server_url)
+                LOG.debug("303 redirect to %s", config.server_url)
                 self.send_response(303)
                 self.send_header("Location", config.server_url)
+                self.send_header("Content-Length", "0")
                 self.end_headers()
                 return True
         except:
@@ -72,29 +219,67 @@ class CaptiveHTTPRequestHandler(SimpleHTTPRequestHandler):
             return False
 
 
+class CaptiveHTTPServer(ThreadingMixIn, TCPServer):
+    """ Serve each connection on its own thread, up to max_connections """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 32  # phones fire many connectivity probes at once
+
+    def __init__(self, address, handler,
+                 max_connections=config.http_max_connections):
+        self.slots = BoundedSemaphore(max_connections)
+        self.probe_lock = Lock()
+        self.probe_hits = Counter()
+        super(CaptiveHTTPServer, self).__init__(address, handler)
+
+    def count_probe(self, name):
+        with self.probe_lock:
+            self.probe_hits[name] += 1
+
+    def stats(self):
+        with self.probe_lock:
+            return {'probes': dict(self.probe_hits)}
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()  # excess connections wait in the listen backlog
+        super(CaptiveHTTPServer, self).process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super(CaptiveHTTPServer, self).process_request_thread(
+                request, client_address)
+        finally:
+            self.slots.release()
+
+
 class WebServer(Thread):
     """ Web server for devices connected to the temporary access point """
 
     def __init__(self, host, port):
         super(WebServer, self).__init__()
-        LOG.info("Creating TCPServer...")
+        LOG.info("Creating CaptiveHTTPServer...")
         root = getattr(sys, '_MEIPASS', abspath(dirname(__file__) + '/..'))
 
         self.daemon = True
         self.dir = os.path.join(root, 'wifisetup', 'web')
         try:
-            self.server = TCPServer((host, port), CaptiveHTTPRequestHandler)
+            self.server = CaptiveHTTPServer((host, port),
+                                            CaptiveHTTPRequestHandler)
         except OSError:
             raise RuntimeError('Could not create webserver! Port already in use.')
+        self.server.assets = AssetCache(self.dir)
+        self.server.portal = PortalHub()
+        self.portal = self.server.portal
 
     def shutdown(self):
+        self.portal.close()
         Thread(target=self.server.shutdown, daemon=True).start()
         self.server.server_close()
         self.join(0.5)
+        LOG.info('Web server stats: %s', self.server.stats())
 
     def run(self):
         LOG.info("Starting Web Server at %s:%s" % self.server.server_address)
         LOG.info("Serving from: %s" % self.dir)
-        os.chdir(self.dir)
         self.server.serve_forever()
         LOG.info("Web Server stopped!")
@@ -14,7 +14,6 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with Mycroft Core.  If not, see <http://www.gnu.org/licenses/>.
-import os
 import time
 import json
 from ast import literal_eval
@@ -23,17 +22,34 @@ from logging import getLogger
 from threading import Thread
 from time import sleep
 
-from pyric import pyw
-from websocket import WebSocketApp
 from wifi import Cell
 
 from wifisetup import config
 from wifisetup.access_point import AccessPoint
-from wifisetup.util import trigger_event, cli_no_output, cli, wpa
+from wifisetup.backend import create_backend
+from wifisetup.connection import ConnectionAttempt
+from wifisetup.dispatcher import Dispatcher
+from wifisetup.dns_server import DnsServer
+from wifisetup.known_networks import KnownNetworks
+from wifisetup.leases import LeaseWatcher
+from wifisetup.transport import BusTransport
+from wifisetup.scanner import ScanCache
+from wifisetup.neighbours import NeighbourTable, NeighbourMonitor, \
+    NUD_UNRESOLVED
+from wifisetup.util import executor, trigger_event, use_ctrl_dir, wpa, \
+    wpa_add_network, wpa_batch, wpa_status
 from wifisetup.web_server import WebServer
 
 LOG = getLogger(__name__)
 
+QUALITY_THRESHOLD = 0.05  # smaller signal changes are not sent to the portal
+
+# Portal messages that other services on the messagebus also listen for
+BUS_RELAY = {'connection.status'}
+
+# Values that clear the join hints, so the saved network is not tied to them
+HINT_RESETS = {'scan_freq': '""', 'bssid': 'any'}
+
 
 class WifiClient:
     """
@@ -43,31 +59,66 @@ class WifiClient:
         >>> client = WifiClient()  # Starts client
         >>> client.join()
     """
-    def __init__(self, allow_timeout=True):
+    def __init__(self, allow_timeout=True, backend=None):
         self.allow_timeout = allow_timeout
+        self.backend = backend or create_backend()
+        use_ctrl_dir(self.backend.ctrl_dir)
         self.running = False
+        self.has_connected = False
+        self.stations = set()
+        self.last_activity = time.time()
+        self.listener = None
+        self.arp_failures = 0
+        self.scan_seq = 0
+        self.sent_networks = None
+        self.known = KnownNetworks(self.backend.known_networks_file)
+        self.attempt = None
 
-        self.last_lease_mod = self.get_last_lease_mod()
-        self.wiface = pyw.winterfaces()[0]
-        self.ap = AccessPoint(self.wiface)
-        self.client = WebSocketApp(url=config.websocket['url'], on_message=self.on_message)
-        Thread(target=self.client.run_forever).start()
+        # Javascript events
+        self.dispatcher = Dispatcher()
+        self.dispatcher.register('wifi.cancel', self.cancel, preempt=True)
+        self.dispatcher.register('wifi.stop', self.close, preempt=True)
+        self.dispatcher.register('wifi.scan', self.scan, queue='scan',
+                                 coalesce=True)
+        self.dispatcher.register('wifi.connect', self.connect, queue='connect')
+
+        self.neighbours = NeighbourTable()
+        self.neighbour_monitor = NeighbourMonitor()
+        self.neighbour_monitor.subscribe(self.on_neighbour)
+        self.wiface = self.backend.interfaces()[0]
+        self.scanner = self.backend.create_scanner(self.wiface)
+        self.scan_cache = ScanCache(self.scan_cells, config.scan_cache_ttl)
+        # Start scanning while the access point comes up so the portal's
+        # first wifi.scan is answered from memory. Background scans pause
+        # once a phone joined, as they take the shared radio off channel
+        self.scan_cache.start(config.scan_refresh_interval)
+        self.ap = AccessPoint(self.wiface, self.backend.run_dir,
+                              not config.dns_server, self.backend)
+        self.leases = LeaseWatcher(self.ap.lease_file)
+        self.leases.on('join', self.on_lease)
+        self.leases.on('renew', self.on_lease)
+        self.client = None
+        if self.backend.bus_url:
+            self.client = BusTransport(self.backend.bus_url, self.on_message)
+            self.client.start()
         self.run_thread = Thread(target=self.run, daemon=True)
 
         self.server = None
+        self.dns = None
         try:
-            self.server = WebServer(self.ap.ip, 80)
+            self.server = WebServer(self.backend.http_host or self.ap.ip,
+                                    self.backend.http_port)
+            self.server.portal.on_message = self.dispatcher.dispatch
             self.server.start()
+            if config.dns_server:
+                self.dns = DnsServer(self.ap.ip)
+                self.dns.start()
         except RuntimeError:
             self.close()
             raise
 
         self.run_thread.start()
 
-    def get_last_lease_mod(self):
-        """When a new user connects, the lease modification time changes"""
-        return os.path.getmtime('/var/lib/misc/dnsmasq.leases')
-
     def join(self):
         """Waits for wifi setup to complete"""
         try:
@@ -77,23 +128,16 @@ class WifiClient:
             self.close()
 
     def notify_server(self, name, data=None):
-        """Send a message to javascript"""
-        self.client.send(json.dumps({'type': name, 'data': data or {}}))
+        """Send a message to the portal page and to the bus if it listens"""
+        if self.server:
+            self.server.portal.send(name, data)
+        if name in BUS_RELAY and self.client:
+            self.client.send(name, data)
 
     def on_message(self, _, message: str):
-        """Handle communication from javascript"""
+        """Handle commands sent over the messagebus"""
         message = json.loads(message)
-
-        def invalid_message(**_):
-            pass
-
-        # Javascript events
-        {
-            'wifi.cancel': self.cancel,
-            'wifi.stop': self.close,
-            'wifi.scan': self.scan,
-            'wifi.connect': self.connect
-        }.get(message['type'], invalid_message)(**message.get('data', {}))
+        self.dispatcher.dispatch(message['type'], message.get('data', {}))
 
     def run(self):
         """
@@ -106,84 +150,155 @@ class WifiClient:
             LOG.exception('Error in wifi client:')
             self.close()
 
+    def start_station_listener(self):
+        """Track phones through AP-STA events, None if polling is needed"""
+        try:
+            listener = self.backend.create_event_listener(self.ap.iface)
+        except (OSError, RuntimeError):
+            LOG.warning('No wpa events for %s, polling instead', self.ap.iface)
+            return None
+        listener.on('AP-STA-CONNECTED', self.on_station_connected)
+        listener.on('AP-STA-DISCONNECTED', self.on_station_disconnected)
+        listener.start()
+        return listener
+
+    def on_station_connected(self, args):
+        LOG.info('Station connected: ' + args[0])
+        self.stations.add(args[0])
+        self.last_activity = time.time()
+        if not self.has_connected:
+            trigger_event('ap_device_connected', {'mac': args[0]},
+                          'wpa_events')
+        self.has_connected = True
+        self.scan_cache.pause('station')
+
+    def on_station_disconnected(self, args):
+        LOG.info('Station disconnected: ' + args[0])
+        self.stations.discard(args[0])
+        if not self.stations and self.has_connected:
+            trigger_event('ap_device_disconnected', {'mac': args[0]},
+                          'wpa_events')
+            self.has_connected = False
+            self.scan_cache.resume('station')
+
+    def on_lease(self, lease):
+        """A device got or renewed an address on the access point"""
+        LOG.info('Lease for %s (%s) at %s', lease['hostname'] or '?',
+                 lease['mac'], lease['ip'])
+        if not self.has_connected:
+            trigger_event('ap_device_connected', lease, 'leases')
+        self.has_connected = True
+        self.scan_cache.pause('station')
+        self.arp_failures = 0
+        self.last_activity = time.time()  # reset after connection
+
     def monitor_connection(self):
         trigger_event('ap_up')
-        has_connected = False
-        num_failures = 0
-        start_time = time.time()
+        self.last_activity = time.time()
         self.running = True
+        self.listener = self.start_station_listener()
+        self.leases.start()
+        self.neighbour_monitor.start()
 
         while self.running:
-            # do our monitoring...
-            mod_time = self.get_last_lease_mod()
-            if self.last_lease_mod != mod_time:
-                # Something changed in the dnsmasq lease file -
-                # presumably a (re)new lease
-                if not has_connected:
-                    trigger_event('ap_device_connected')
-                has_connected = True
-                num_failures = 0
-                self.last_lease_mod = mod_time
-                start_time = time.time()  # reset start time after connection
-
-            if time.time() - start_time > 60 * 5 and self.allow_timeout:
+            # Station events make polling unnecessary while the listener lives
+            if not (self.listener and self.listener.is_alive()):
+                self.poll_connection()
+
+            if time.time() - self.last_activity > 60 * 5 and self.allow_timeout:
                 # After 5 minutes, shut down the access point (unless the
                 # system has never been setup, in which case we stay up
                 # indefinitely)
                 LOG.info("Auto-shutdown of access point after 5 minutes")
                 self.cancel()
                 continue
-
-            if has_connected:
-                # Flush the ARP entries associated with our access point
-                # This will require all network hardware to re-register
-                # with the ARP tables if still present.
-                if num_failures == 0:
-                    cli_no_output('ip', '-s', '-s', 'neigh', 'flush',
-                                        self.ap.subnet + '.0/24')
-
-                # now look at the hardware that has responded, if no entry
-                # shows up on our access point after 2*5=10 seconds, the user
-                # has disconnected
-                if not self.is_ARP_filled():
-                    num_failures += 1
-                    LOG.info('Lost connection: ' + str(num_failures))
-                    if num_failures > 5:
-                        trigger_event('ap_device_disconnected')
-                        has_connected = False
-                else:
-                    num_failures = 0
             sleep(5)  # wait a bit to prevent thread from hogging CPU
 
-    def is_ARP_filled(self):
-        out = cli_no_output('/usr/sbin/arp', '-n')["stdout"]
-        if not out:
-            return False
-        # Parse output, skipping header
-        for o in out.split("\n")[1:]:
-            if o.startswith(self.ap.subnet):
-                if "(incomplete)" in o:
-                    # ping the IP to get the ARP table entry reloaded
-                    ip_disconnected = o.split(" ")[0]
-                    cli_no_output('/bin/ping', '-c', '1', '-W', '3',
-                                  ip_disconnected)
-                else:
-                    return True  # something on subnet is connected!
-        return False
+    def poll_connection(self):
+        """Fallback disconnect detection through the ARP table"""
+        if self.has_connected:
+            # Flush the ARP entries associated with our access point
+            # This will require all network hardware to re-register
+            # with the ARP tables if still present.
+            if self.arp_failures == 0:
+                self.neighbours.flush(self.ap.subnet + '.0/24')
+
+            # now look at the hardware that has responded, if no entry
+            # shows up on our access point after 2*5=10 seconds, the user
+            # has disconnected
+            if not self.is_ARP_filled():
+                self.arp_failures += 1
+                LOG.info('Lost connection: %d', self.arp_failures)
+                if self.arp_failures > 5:
+                    trigger_event('ap_device_disconnected', {}, 'neighbours')
+                    self.has_connected = False
+                    self.scan_cache.resume('station')
+            else:
+                self.arp_failures = 0
 
-    def scan(self):
-        trigger_event('ap_scan')
-        LOG.info("Scanning wifi connections...")
-        networks = {}
-        status = self.get_connection_info()
+    def on_neighbour(self, event, entry):
+        """A device on the access point answered ARP, it is still there"""
+        if (event == 'new' and entry['ip'] and
+                entry['ip'].startswith(self.ap.subnet + '.') and
+                not entry['state'] & NUD_UNRESOLVED):
+            self.arp_failures = 0
 
+    def is_ARP_filled(self):
+        return self.neighbours.is_reachable(self.ap.subnet + '.0/24')
+
+    def scan_cells(self):
+        """Scan through nl80211, falling back to iwlist"""
+        if self.scanner:
+            try:
+                return self.scanner.scan()
+            except OSError:
+                LOG.exception('nl80211 scan failed, using iwlist')
+        return self.scan_iwlist()
+
+    def scan_iwlist(self):
+        return executor.run(['iwlist', self.wiface, 'scan'],
+                            self.read_iwlist, [], forks=1)
+
+    def read_iwlist(self):
+        cells = []
         for cell in Cell.all(self.wiface):
             if "x00" in cell.ssid:
                 continue  # ignore hidden networks
+            cells.append({
+                # Fix UTF-8 characters
+                'ssid': literal_eval("b'" + cell.ssid + "'").decode('utf8'),
+                'bssid': cell.address.lower(),
+                'freq': self.get_freq(cell.frequency),
+                'quality': self.get_quality(cell.quality),
+                'encrypted': cell.encrypted
+            })
+        return cells
 
-            # Fix UTF-8 characters
-            ssid = literal_eval("b'" + cell.ssid + "'").decode('utf8')
-            quality = self.get_quality(cell.quality)
+    def scan(self):
+        """
+        Answer with the best list available right away, then send what a
+        scan younger than scan_cache_ttl changed as a delta
+        """
+        trigger_event('ap_scan')
+        LOG.info("Scanning wifi connections...")
+        status = self.get_connection_info()
+        snapshot = self.scan_cache.snapshot()
+        if snapshot is None and self.scanner:
+            try:
+                snapshot = self.scanner.results()  # kernel's last BSS table
+            except OSError:
+                pass
+        if snapshot is not None:
+            self.send_networks(snapshot, status, full=True)
+        cells = self.scan_cache.get()
+        if cells is not snapshot:
+            self.send_networks(cells, status, full=snapshot is None)
+
+    def get_networks(self, cells, status):
+        networks = {}
+        for cell in cells:
+            ssid = cell['ssid']
+            quality = cell['quality']
 
             # If there are duplicate network IDs (e.g. repeaters) only
             # report the strongest signal
@@ -193,44 +308,178 @@ class WifiClient:
             if update and ssid:
                 networks[ssid] = {
                     'quality': quality,
-                    'encrypted': cell.encrypted,
+                    'encrypted': cell['encrypted'],
                     'connected': self.is_connected(ssid, status),
                     'demo': False
                 }
-        LOG.info("Found wifi networks: %s" % networks)
-        self.notify_server('wifi.scanned', {'networks': networks})
+        return networks
+
+    def diff_networks(self, networks):
+        """Changes since the last list sent, keyed by SSID"""
+        old = self.sent_networks
+        added = {k: v for k, v in networks.items() if k not in old}
+        removed = [k for k in old if k not in networks]
+        changed = {}
+        for ssid, new in networks.items():
+            prev = old.get(ssid)
+            if prev and (abs(prev['quality'] - new['quality']) >
+                         QUALITY_THRESHOLD or
+                         prev['connected'] != new['connected'] or
+                         prev['encrypted'] != new['encrypted']):
+                changed[ssid] = new
+        for ssid in removed:
+            del old[ssid]
+        old.update(added)
+        old.update(changed)
+        return {'added': added, 'removed': removed, 'changed': changed}
+
+    def send_networks(self, cells, status, full=False):
+        """
+        Send the whole list as {seq, networks} or only the differences as
+        {seq, added, removed, changed}
+        """
+        networks = self.get_networks(cells, status)
+        if full or self.sent_networks is None:
+            self.sent_networks = networks
+            data = {'networks': networks}
+        else:
+            data = self.diff_networks(networks)
+            if not any(data.values()):
+                return
+        self.scan_seq += 1
+        data['seq'] = self.scan_seq
+        LOG.debug("Found wifi networks: %s", data)
+        self.notify_server('wifi.scanned', data)
 
     @staticmethod
     def get_quality(quality):
         values = quality.split("/")
         return float(values[0]) / float(values[1])
 
+    @staticmethod
+    def get_freq(frequency):
+        """Convert iwlist frequencies like '2.412 GHz' to MHz"""
+        if not frequency:
+            return None
+        value, unit = frequency.split()
+        return int(round(float(value) * (1000 if unit == 'GHz' else 1)))
+
     def connect(self, ssid, password=None):
         LOG.info('Connecting to ' + ssid + '...')
         connected = self.is_connected(ssid)
+        attempt = None
+        reason = None
 
         if connected:
             LOG.warning("Device is already connected to %s" % ssid)
         else:
             self.disconnect()
             LOG.info("Connecting to: %s" % ssid)
-            nid = wpa(self.wiface, 'add_network')
-            wpa(self.wiface, 'set_network', nid, 'ssid', '"' + ssid + '"')
-
-            if password:
-                psk = '"' + password + '"'
-                wpa(self.wiface, 'set_network', nid, 'psk', psk)
-            else:
-                wpa(self.wiface, 'set_network', nid, 'key_mgmt', 'NONE')
+            self.scan_cache.pause('connect')  # scanning disturbs association
+            try:
+                connected, attempt, reason = self.join_network(ssid, password)
+            finally:
+                self.scan_cache.resume('connect')
+
+        status = {
+            'connected': connected,
+            'reason': reason,
+            'timeline': attempt.timeline if attempt else {}
+        }
+        trigger_event('ap_connection_success' if connected
+                      else 'ap_connection_failed', dict(status, ssid=ssid))
+        self.notify_server('connection.status', status)
+        if attempt:
+            attempt.close()  # after the page has its answer
+        LOG.info("Connection status for %s = %s" % (ssid, connected))
 
-            wpa(self.wiface, 'enable', nid)
-            connected = self.get_connected(ssid)
+    def join_network(self, ssid, password):
+        """Returns: (connected, attempt or None, reason of a failure)"""
+        try:
+            nid = str(wpa_add_network(self.wiface))
+        except RuntimeError as e:
+            LOG.error(str(e))
+            return False, None, 'add_network_failed'
+        attempt = None
+        try:
+            attempt = self.attempt = ConnectionAttempt(
+                self.backend.create_event_listener(self.wiface), nid)
+        except (OSError, RuntimeError):
+            LOG.warning('No wpa events, polling connection status')
+        if password:
+            key = ['set_network', nid, 'psk', '"' + password + '"']
+        else:
+            key = ['set_network', nid, 'key_mgmt', 'NONE']
+        hints = self.get_hints(ssid, nid)
+        wpa_batch(self.wiface,
+                  ['set_network', nid, 'ssid', '"' + ssid + '"'],
+                  key, *hints, ['enable', nid])
+        if attempt:
+            connected = attempt.wait(config.connect_timeout)
             if connected:
-                wpa(self.wiface, 'save_config')
+                self.wait_for_address(attempt)
+            self.attempt = None
+        else:
+            connected = self.get_connected(ssid)
+        if connected:
+            self.remember_network(ssid, attempt)
+            self.remove_duplicates(ssid, nid)
+            # Hints only speed up this join, later ones scan every channel
+            wpa_batch(self.wiface, *[
+                ['set_network', nid, name, HINT_RESETS[name]]
+                for _, _, name, _ in hints
+            ], ['save_config'])
+        else:
+            # A failed block would keep retrying and answer the next attempt
+            wpa(self.wiface, 'remove_network', nid)
+        return connected, attempt, attempt and attempt.reason
 
-        trigger_event('ap_connection_success' if connected else 'ap_connection_failed')
-        self.notify_server('connection.status', {'connected': connected})
-        LOG.info("Connection status for %s = %s" % (ssid, connected))
+    def get_hints(self, ssid, nid):
+        """
+        Network settings that let wpa_supplicant skip the full band scan,
+        using the channels of earlier joins and of the last scan
+        """
+        known = self.known.get(ssid) or {}
+        freqs = {cell['freq'] for cell in self.scan_cache.snapshot() or []
+                 if cell['ssid'] == ssid and cell['freq']}
+        if known.get('freq'):
+            freqs.add(known['freq'])
+        hints = []
+        if freqs:
+            hints.append(['set_network', nid, 'scan_freq',
+                          ' '.join(str(f) for f in sorted(freqs))])
+        if config.pin_known_bssid and known.get('bssid'):
+            hints.append(['set_network', nid, 'bssid', known['bssid']])
+        return hints
+
+    def remember_network(self, ssid, attempt):
+        status = self.get_connection_info()
+        freq = status.get('freq')
+        self.known.remember(
+            ssid, status.get('bssid'), int(freq) if freq else None,
+            status.get('key_mgmt'),
+            attempt.timeline.get('connected') if attempt else None
+        )
+
+    def remove_duplicates(self, ssid, nid):
+        """Drop older blocks for the same SSID so save_config won't pile up"""
+        out = wpa_batch(self.wiface, ['list_networks'])[0]
+        for line in out.split('\n')[1:]:
+            fields = line.split('\t')
+            if len(fields) > 1 and fields[1] == ssid and fields[0] != nid:
+                LOG.info('Removing duplicate network %s for %s', fields[0], ssid)
+                wpa(self.wiface, 'remove_network', fields[0])
+
+    def wait_for_address(self, attempt, interval=0.1):
+        """Record when DHCP gave the station an address"""
+        end = time.monotonic() + config.dhcp_timeout
+        while time.monotonic() < end:
+            if self.get_connection_info().get('ip_address'):
+                attempt.mark('dhcp')
+                return True
+            sleep(interval)
+        LOG.warning('No address after %ss', config.dhcp_timeout)
+        return False
 
     def disconnect(self):
         """Disconnect from current SSID"""
@@ -242,11 +491,7 @@ class WifiClient:
             LOG.info("Disconnecting %s id: %s" % (ssid, nid))
 
     def get_connection_info(self):
-        res = cli('wpa_cli', '-i', self.wiface, 'status')
-        out = str(res["stdout"])
-        if out:
-            return dict(o.split("=") for o in out.split("\n")[:-1])
-        return {}
+        return wpa_status(self.wiface)
 
     def get_connected(self, ssid, retry=5):
         connected = self.is_connected(ssid)
@@ -268,11 +513,27 @@ class WifiClient:
     def close(self):
         trigger_event('ap_down')
         self.running = False
+        self.dispatcher.stop()
+        if self.attempt:
+            self.attempt.cancel()
+        self.scan_cache.stop()
+        if self.listener:
+            self.listener.stop()
+        self.leases.stop()
+        self.neighbour_monitor.stop()
+        self.neighbours.close()
+        if self.scanner:
+            self.scanner.close()
         LOG.info('Shutting down access point...')
         self.ap.close()
         LOG.info('Sending shutdown signal...')
         if self.server:
             self.server.shutdown()
-        LOG.info('Closing websocket...')
-        self.client.close()
+        if self.dns:
+            self.dns.shutdown()
+        LOG.info('Command stats: %s', executor.stats())
+        if self.client:
+            LOG.info('Closing websocket... %s', self.client.stats())
+            self.client.close()
+        self.backend.close()
         LOG.info("Wifi client stopped!")
@@ -0,0 +1,211 @@
+# Copyright 2017 Mycroft AI, Inc.
+#
+# This file is part of Mycroft Wifi Setup.
+#
+# Mycroft Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mycroft Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mycroft Core.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import socket
+from itertools import count
+from logging import getLogger
+from os.path import join
+from select import select
+from threading import Lock, Thread, current_thread
+
+LOG = getLogger(__name__)
+
+CTRL_DIR = '/var/run/wpa_supplicant'
+BUFFER_SIZE = 8192
+
+# wpa_cli accepts abbreviated commands, the control socket does not
+COMMAND_ALIASES = {
+    'enable': 'ENABLE_NETWORK',
+    'disable': 'DISABLE_NETWORK',
+    'select': 'SELECT_NETWORK',
+    'remove': 'REMOVE_NETWORK'
+}
+
+
+def format_command(*args):
+    """Translate wpa_cli style arguments into a control socket command"""
+    name = args[0].lower()
+    return ' '.join([COMMAND_ALIASES.get(name, name.upper())] + list(args[1:]))
+
+
+def parse_status(out):
+    """Parse the key=value lines returned by STATUS"""
+    return dict(line.partition('=')[::2] for line in out.split('\n')
+                if '=' in line)
+
+
+def parse_network_id(out):
+    """Id returned by ADD_NETWORK, raises RuntimeError on FAIL"""
+    out = out.strip()
+    if not out.isdigit():
+        raise RuntimeError('Could not add network: ' + out)
+    return int(out)
+
+
+def parse_passphrase(out, iface):
+    """Passphrase returned by P2P_GET_PASSPHRASE, raises RuntimeError on FAIL"""
+    out = out.strip()
+    if not out or out.startswith('FAIL'):
+        raise RuntimeError('No passphrase for ' + iface)
+    return out
+
+
+class WpaCtrl:
+    """
+    Persistent connection to the wpa_supplicant control socket of an interface
+
+    Usage:
+        >>> ctrl = WpaCtrl('wlan0')
+        >>> ctrl.status()['wpa_state']
+        'COMPLETED'
+    """
+    _ids = count()
+
+    def __init__(self, iface, ctrl_dir=CTRL_DIR, timeout=10):
+        self.iface = iface
+        self.lock = Lock()
+        self.local = '/tmp/wpa_ctrl_{}-{}'.format(os.getpid(), next(self._ids))
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            if os.path.exists(self.local):
+                os.unlink(self.local)
+            self.sock.bind(self.local)
+            self.sock.connect(join(ctrl_dir, iface))
+            self.sock.settimeout(timeout)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.local)
+        except OSError:
+            pass
+
+    def _recv(self):
+        """Receive the next reply, skipping any unsolicited event"""
+        while True:
+            data = self.sock.recv(BUFFER_SIZE).decode('utf8', 'replace')
+            if not data.startswith('<'):
+                return data
+
+    def request(self, *args):
+        """Send a single command and return the raw reply"""
+        return self.pipeline(args)[0]
+
+    def pipeline(self, *commands):
+        """
+        Send several commands back to back and collect their replies in order.
+        wpa_supplicant handles datagrams sequentially so replies line up
+        """
+        with self.lock:
+            for args in commands:
+                self.sock.send(format_command(*args).encode('utf8'))
+            return [self._recv() for _ in commands]
+
+    def attach(self):
+        """Subscribe this connection to unsolicited events"""
+        if self.request('attach').strip() != 'OK':
+            raise RuntimeError('Could not attach to ' + self.iface)
+
+    def ping(self):
+        return self.request('ping').strip() == 'PONG'
+
+    def status(self):
+        return parse_status(self.request('status'))
+
+    def add_network(self):
+        return parse_network_id(self.request('add_network'))
+
+    def p2p_get_passphrase(self):
+        return parse_passphrase(self.request('p2p_get_passphrase'), self.iface)
+
+
+class WpaEventDispatcher(Thread):
+    """ Thread that passes the events of an interface to handlers by name """
+
+    def __init__(self, iface):
+        super(WpaEventDispatcher, self).__init__(daemon=True)
+        self.iface = iface
+        self.handlers = {}
+        self.running = True
+
+    def on(self, name, handler):
+        self.handlers.setdefault(name, []).append(handler)
+
+    def dispatch(self, message):
+        """Handle a message like '<3>AP-STA-CONNECTED 02:00:00:00:01:00'"""
+        if message.startswith('<'):
+            message = message.partition('>')[2]
+        name, _, args = message.strip().partition(' ')
+        for handler in self.handlers.get(name, []):
+            try:
+                handler(args.split())
+            except:
+                LOG.exception('Error handling ' + name)
+
+
+class WpaEventListener(WpaEventDispatcher):
+    """
+    Dispatch the unsolicited events of an interface to handlers by name
+
+    Usage:
+        >>> listener = WpaEventListener('p2p-wlan0-0')
+        >>> listener.on('AP-STA-CONNECTED', lambda args: print(args[0]))
+        >>> listener.start()
+    """
+    def __init__(self, iface, ctrl_dir=CTRL_DIR):
+        super(WpaEventListener, self).__init__(iface)
+        self.wake_read, self.wake_write = os.pipe()  # lets stop() end a wait
+        self.ctrl = WpaCtrl(iface, ctrl_dir, timeout=1)
+        try:
+            self.ctrl.attach()
+        except (OSError, RuntimeError):
+            self.ctrl.close()
+            self.close_wake_pipe()
+            raise
+
+    def close_wake_pipe(self):
+        for fd in (self.wake_read, self.wake_write):
+            os.close(fd)
+        self.wake_read = self.wake_write = None
+
+    def run(self):
+        while self.running:
+            try:
+                readable = select([self.ctrl.sock, self.wake_read], [], [])[0]
+                if self.wake_read in readable:
+                    break  # woken by stop()
+                data = self.ctrl.sock.recv(BUFFER_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                LOG.exception('Lost event connection to ' + self.iface)
+                break
+            self.dispatch(data.decode('utf8', 'replace'))
+        self.running = False
+
+    def stop(self):
+        self.running = False
+        if self.wake_write is None:
+            return  # already stopped
+        os.write(self.wake_write, b'x')
+        if self.is_alive() and self is not current_thread():
+            self.join(2)
+        self.ctrl.close()
+        self.close_wake_pipe()